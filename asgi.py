@@ -0,0 +1,134 @@
+"""
+asgi -- run a WSGI application behind an ASGI server, keeping its blocking work off the event loop
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+
+
+class ASGIApplication:
+    def __init__(self, wsgi_app, *, threads=32, max_waiting=256, max_body_size=64 * 1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.threads = threads
+        self.max_waiting = max_waiting
+        self.max_body_size = max_body_size
+        self.slots = None
+        self.waiting = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        # idle connections cost an ASGI server next to nothing; requests which want a thread queue up for one, and
+        # once too many are queued we turn new ones away rather than letting latency grow without bound
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.threads)
+        if self.slots.locked() and self.waiting >= self.max_waiting:
+            return await self.send_simple(send, 503, b'Server busy, please try again shortly.', [(b'retry-after', b'1')])
+
+        body = await self.read_body(receive)
+        if body is None:
+            return await self.send_simple(send, 413, b'Request body too large.')
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            await self.run(scope, body, send)
+        finally:
+            self.slots.release()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect': break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size: return None
+            chunks.append(chunk)
+            if not message.get('more_body', False): break
+        return b''.join(chunks)
+
+    async def send_simple(self, send, status, body, headers=()):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode('us-ascii'))] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0],
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                continue
+            else:
+                key = 'HTTP_' + name
+                # repeated headers are folded into one; cookies are the exception, with their own separator
+                separator = '; ' if name == 'COOKIE' else ','
+                environ[key] = (environ[key] + separator + value) if key in environ else value
+        return environ
+
+    async def run(self, scope, body, send):
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return lambda data: None
+
+        # the routing, rendering, git and database work all happen in here
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        iterator = iter(result)
+        end = object()
+        try:
+            # the body might be generated lazily (blobs are streamed in chunks), so pull it off a thread too
+            chunk = await loop.run_in_executor(self.executor, next, iterator, end)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not end:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, end)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
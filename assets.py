@@ -0,0 +1,62 @@
+"""
+assets -- static bundles, built once and kept in memory ready-compressed
+"""
+import gzip
+import hashlib
+import os
+import os.path
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class BuiltBundle:
+    def __init__(self, data):
+        self.data = data
+        self.hash = hashlib.sha1(data).hexdigest()
+        self.encodings = {'identity': data, 'gzip': gzip.compress(data, 9)}
+        if brotli:
+            self.encodings['br'] = brotli.compress(data)
+
+    def etag(self, encoding):
+        # each encoding is a different representation, so it needs its own strong tag
+        return self.hash if encoding == 'identity' else '%s-%s' % (self.hash, encoding)
+
+class Bundle:
+    def __init__(self, directory, filenames):
+        self.directory = directory
+        self.filenames = filenames
+        self.stamp = None
+        self.built = None
+        self.lock = threading.Lock()
+
+    def current_stamp(self):
+        stamp = []
+        for filename in self.filenames:
+            st = os.stat(os.path.join(self.directory, filename))
+            stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        return stamp
+
+    # rebuilt only when one of the files changes on disk
+    def current(self):
+        stamp = self.current_stamp()
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    parts = []
+                    for filename in self.filenames:
+                        with open(os.path.join(self.directory, filename), 'rb') as file:
+                            parts.append(file.read())
+                            parts.append(b'\n')
+                    self.built = BuiltBundle(b''.join(parts))
+                    self.stamp = stamp
+        return self.built
+
+    def choose_encoding(self, request, built):
+        for encoding in ('br', 'gzip'):
+            if encoding in built.encodings and request.accept_encodings[encoding]:
+                return encoding
+        return 'identity'
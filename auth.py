@@ -0,0 +1,114 @@
+"""
+auth -- avoid paying for bcrypt on every request an editor makes
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import os.path
+import threading
+import time
+from collections import OrderedDict
+
+import bcrypt
+
+
+# anything about an editor's entry changing (password, name, removal) changes this, which invalidates their cache
+# entries and session tokens without any bookkeeping
+def entry_fingerprint(username, entry):
+    return hashlib.sha256(json.dumps([username, entry], sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_secret(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    secret = os.urandom(32)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another worker got there first
+        with open(path, 'rb') as f:
+            return f.read()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+class CredentialCache:
+    def __init__(self, ttl=300, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # the key is per-process, so nothing in memory can be used to test passwords offline
+        self.key = os.urandom(32)
+        self.verified = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cache_key(self, username, password, entry):
+        message = b'\0'.join([username.encode('utf-8'), password, entry_fingerprint(username, entry).encode('us-ascii')])
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def check(self, username, password, entry):
+        key = self.cache_key(username, password, entry)
+        now = time.monotonic()
+        with self.lock:
+            expiry = self.verified.get(key)
+            if expiry is not None and expiry > now:
+                self.verified.move_to_end(key)
+                return True
+
+        real_password = entry['password'].encode('utf-8')
+        if bcrypt.hashpw(password, real_password) != real_password:
+            return False
+
+        with self.lock:
+            self.verified[key] = now + self.ttl
+            while len(self.verified) > self.max_entries:
+                self.verified.popitem(last=False)
+        return True
+
+# tokens are username, expiry and entry fingerprint, signed with a key kept in the repository so every worker
+# process accepts every other's tokens
+class SessionSigner:
+    cookie_name = 'ikwi_session'
+
+    def __init__(self, key_path, lifetime=7 * 24 * 60 * 60):
+        self.key_path = key_path
+        self.lifetime = lifetime
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = load_secret(self.key_path)
+        return self._key
+
+    def signature(self, payload):
+        return hmac.new(self.key, payload.encode('us-ascii'), hashlib.sha256).hexdigest()
+
+    def issue(self, username, entry):
+        payload = '%s.%d.%s' % (
+            base64.urlsafe_b64encode(username.encode('utf-8')).decode('us-ascii'),
+            int(time.time()) + self.lifetime,
+            entry_fingerprint(username, entry)
+        )
+        return payload + '.' + self.signature(payload)
+
+    # returns the username if the token is genuine, unexpired, and the editor's entry hasn't changed since
+    def verify(self, token, editors):
+        # compare_digest only takes ASCII strs, and the token comes from a client, so everything is compared as bytes;
+        # a token that isn't even ASCII can't be one of ours
+        try:
+            encoded_username, expiry, fingerprint, signature = token.split('.')
+            payload = '%s.%s.%s' % (encoded_username, expiry, fingerprint)
+            if not hmac.compare_digest(signature.encode('us-ascii'), self.signature(payload).encode('us-ascii')): return None
+            if int(expiry) < time.time(): return None
+            username = base64.urlsafe_b64decode(encoded_username.encode('us-ascii')).decode('utf-8')
+        except (ValueError, UnicodeError):
+            return None
+
+        if username not in editors: return None
+        if not hmac.compare_digest(fingerprint.encode('us-ascii'), entry_fingerprint(username, editors[username]).encode('us-ascii')): return None
+        return username
@@ -0,0 +1,222 @@
+"""
+cache -- persistent caches which live alongside the indexes in the repository
+"""
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class RenderCache:
+    database_name = 'render.sqlite3'
+
+    def __init__(self, site, max_size=64 * 1024 * 1024, flush_interval=30):
+        self.site = site
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS renders (key TEXT PRIMARY KEY NOT NULL, html TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lru ON renders (used)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        # use times are only written out now and then, or with a put, so reads never need SQLite's write lock
+        self.touched = {}
+        self.flushed = time.monotonic()
+
+    @property
+    def path(self):
+        return os.path.join(self.site.storage.repo.path, RenderCache.database_name)
+
+    @staticmethod
+    def key(blob_id, page_format, base_url):
+        # blob ids are content hashes, so historical revisions share entries with the latest one when a page hasn't changed
+        return hashlib.sha1('\0'.join((blob_id, page_format, base_url)).encode('utf-8')).hexdigest()
+
+    def flush(self, c):
+        c.executemany('UPDATE renders SET used = ? WHERE key = ?', [(used, key) for key, used in self.touched.items()])
+        self.touched = {}
+        self.flushed = time.monotonic()
+
+    def get(self, blob_id, page_format, base_url):
+        key = RenderCache.key(blob_id, page_format, base_url)
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('SELECT html FROM renders WHERE key = ?', (key,))
+            row = c.fetchone()
+            if row is None: return None
+
+            self.touched[key] = time.time()
+            if time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush(c)
+                self.conn.commit()
+        return row[0]
+
+    def put(self, blob_id, page_format, base_url, html):
+        key = RenderCache.key(blob_id, page_format, base_url)
+        size = len(html.encode('utf-8'))
+        if size > self.max_size: return
+
+        with self.lock:
+            c = self.conn.cursor()
+            # before evicting, so that recently read entries aren't taken for unused ones
+            self.flush(c)
+            c.execute('INSERT OR REPLACE INTO renders (key, html, size, used) VALUES (?, ?, ?, ?)', (key, html, size, time.time()))
+            self.evict(c)
+            self.conn.commit()
+
+    def evict(self, c):
+        c.execute('SELECT COALESCE(SUM(size), 0) FROM renders')
+        total = c.fetchone()[0]
+        if total <= self.max_size: return
+
+        # drop least recently used entries until we're back under budget
+        doomed = []
+        for key, size in c.execute('SELECT key, size FROM renders INDEXED BY lru ORDER BY used ASC').fetchall():
+            if total <= self.max_size: break
+            doomed.append((key,))
+            total -= size
+        c.executemany('DELETE FROM renders WHERE key = ?', doomed)
+
+    def render(self, blob_id, page_format, base_url, renderer):
+        html = self.get(blob_id, page_format, base_url)
+        if html is None:
+            html = renderer()
+            self.put(blob_id, page_format, base_url, html)
+        return html
+
+# results keyed by (index generation, normalised query, page), in SQLite so every worker process shares them
+class SearchCache:
+    database_name = 'search-cache.sqlite3'
+
+    def __init__(self, site, max_entries=1000, flush_interval=30):
+        self.site = site
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (generation TEXT NOT NULL, query TEXT NOT NULL, page INTEGER NOT NULL, pagelen INTEGER NOT NULL, results TEXT NOT NULL, used REAL NOT NULL, PRIMARY KEY (generation, query, page, pagelen))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lru ON results (used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY NOT NULL, value INTEGER NOT NULL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        # a write on every hit would take SQLite's write lock and serialise every worker's reads, so use times and
+        # counts are kept here and written out now and then, or whenever we're writing anyway
+        self.touched = {}
+        self.counts = {'hits': 0, 'misses': 0}
+        self.flushed = time.monotonic()
+
+    @property
+    def path(self):
+        return os.path.join(self.site.storage.repo.path, SearchCache.database_name)
+
+    def flush(self, c):
+        for name, value in self.counts.items():
+            if not value: continue
+            c.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (name,))
+            c.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+        c.executemany('UPDATE results SET used = ? WHERE generation = ? AND query = ? AND page = ? AND pagelen = ?', [(used,) + key for key, used in self.touched.items()])
+        self.touched = {}
+        self.counts = {'hits': 0, 'misses': 0}
+        self.flushed = time.monotonic()
+
+    def get(self, generation, query, page, pagelen):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('SELECT results FROM results WHERE generation = ? AND query = ? AND page = ? AND pagelen = ?', (generation, query, page, pagelen))
+            row = c.fetchone()
+            if row is None:
+                self.counts['misses'] += 1
+            else:
+                self.counts['hits'] += 1
+                self.touched[(generation, query, page, pagelen)] = time.time()
+            if time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush(c)
+                self.conn.commit()
+        return json.loads(row[0]) if row else None
+
+    def put(self, generation, query, page, pagelen, results):
+        with self.lock:
+            c = self.conn.cursor()
+            self.flush(c)
+            # anything from an older generation of the index can never be asked for again
+            c.execute('DELETE FROM results WHERE generation != ?', (generation,))
+            c.execute('INSERT OR REPLACE INTO results (generation, query, page, pagelen, results, used) VALUES (?, ?, ?, ?, ?, ?)', (generation, query, page, pagelen, json.dumps(results), time.time()))
+            c.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results INDEXED BY lru ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            self.flush(self.conn.cursor())
+            self.conn.commit()
+            counters = dict(self.conn.execute('SELECT name, value FROM counters').fetchall())
+            entries = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {'hits': hits, 'misses': misses, 'hit_ratio': (hits / (hits + misses)) if hits + misses else 0.0, 'entries': entries}
+
+# large blobs written out once by oid, so they can be sent from disk (with sendfile, if the server does that)
+# instead of being loaded out of git into memory on every request
+class BlobFileCache:
+    directory_name = 'blobs.cache'
+
+    def __init__(self, site, min_size=1024 * 1024, max_size=1024 * 1024 * 1024):
+        self.site = site
+        self.min_size = min_size
+        self.max_size = max_size
+        if not os.path.isdir(self.path): os.mkdir(self.path)
+
+    @property
+    def path(self):
+        return os.path.join(self.site.storage.repo.path, BlobFileCache.directory_name)
+
+    def path_for(self, blob_id):
+        return os.path.join(self.path, blob_id)
+
+    def lookup(self, blob_id):
+        path = self.path_for(blob_id)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def store(self, blob_id, data):
+        if len(data) < self.min_size or len(data) > self.max_size: return None
+        path = self.path_for(blob_id)
+        # a file of its own for every writer, since threads share a pid
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=blob_id + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # oids are content hashes, so if two writers race here they're writing the same thing, and whichever
+            # rename lands last is as good as the other
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            if not os.path.exists(path): raise
+        self.evict()
+        return path
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'): continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for mtime, size, name in files)
+        for mtime, size, name in sorted(files):
+            if total <= self.max_size: break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
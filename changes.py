@@ -0,0 +1,108 @@
+from datetime import datetime, timezone, timedelta
+import sqlite3
+import threading
+
+import pygit2
+
+if "." in __name__:
+    from .database import Database
+else:
+    from database import Database
+
+
+def commit_date(commit):
+    return datetime.fromtimestamp(commit.commit_time, timezone(timedelta(minutes=commit.commit_time_offset)))
+
+# a log of (date, page, op, revision), kept up to date by the indexer, so recent changes don't walk history
+class ChangesDatabase(Database):
+    database_name = 'changes.sqlite3'
+    needs_documents = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path)
+        return self.local.conn
+
+    def do_create(self):
+        c = self.conn.cursor()
+        c.execute("DROP TABLE IF EXISTS changes")
+        c.execute("CREATE TABLE changes (id INTEGER PRIMARY KEY, date TEXT NOT NULL, time INTEGER NOT NULL, page TEXT NOT NULL, op TEXT NOT NULL, revision TEXT NOT NULL)")
+        c.execute("CREATE INDEX by_date ON changes (date)")
+        self.conn.commit()
+
+    def do_begin(self, rebuilding=False, revision=None):
+        self.cursor = self.conn.cursor()
+        # the indexer's diff lumps together every commit since the last update, so the log is written from the
+        # commits themselves instead, each with its own date; a new log starts from the whole history
+        since = None if rebuilding else self.indexed_revision
+        self.backfill(self.site.storage.repo[revision], since=since)
+
+    def record(self, date, page, op, revision):
+        self.cursor.execute('INSERT INTO changes (date, time, page, op, revision) VALUES (?, ?, ?, ?, ?)', (date.date().isoformat(), int(date.timestamp()), page, op, revision))
+
+    def backfill(self, head, since=None):
+        repo = self.site.storage.repo
+        def pages_tree(commit):
+            if 'pages' not in commit.tree: return None
+            return repo[commit.tree['pages'].id]
+
+        # oldest first, so that within a day the ids come out in the order things happened
+        walker = repo.walk(head.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME | pygit2.GIT_SORT_REVERSE)
+        if since is not None: walker.hide(since)
+        for commit in walker:
+            new_tree = pages_tree(commit)
+            old_tree = pages_tree(commit.parents[0]) if commit.parents else None
+            date = commit_date(commit)
+            revision = str(commit.id)
+
+            if new_tree is None: continue
+            # whatever a merge brings in was already recorded from the commits on the merged branch
+            if len(commit.parents) > 1: continue
+            if old_tree is None:
+                for entry in new_tree:
+                    self.record(date, entry.name, 'created', revision)
+                continue
+
+            for patch in old_tree.diff_to_tree(new_tree):
+                delta = patch.delta
+                if delta.status == pygit2.GIT_DELTA_ADDED:
+                    self.record(date, delta.new_file.path, 'created', revision)
+                elif delta.status == pygit2.GIT_DELTA_MODIFIED:
+                    self.record(date, delta.new_file.path, 'updated', revision)
+                elif delta.status == pygit2.GIT_DELTA_DELETED:
+                    self.record(date, delta.old_file.path, 'deleted', revision)
+
+    def do_apply(self, change, document):
+        # everything was recorded from the commits in do_begin
+        pass
+
+    def do_commit(self):
+        self.conn.commit()
+
+    def do_abort(self):
+        self.conn.rollback()
+
+    def recent(self, days=31, offset=0):
+        self.update()
+        c = self.conn.cursor()
+        # with a background updater, the first build may still be going; until then there's nothing to show
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'changes'")
+        if c.fetchone() is None: return []
+        c.execute('SELECT DISTINCT date FROM changes INDEXED BY by_date ORDER BY date DESC LIMIT ? OFFSET ?', (days, offset))
+        dates = [row[0] for row in c]
+        if not dates: return []
+
+        c.execute('SELECT date, page, op FROM changes INDEXED BY by_date WHERE date BETWEEN ? AND ? ORDER BY date DESC, id ASC', (dates[-1], dates[0]))
+        by_date = {}
+        for date, page, op in c:
+            pages = by_date.setdefault(date, {})
+            # a page created and then edited on the same day was, as far as that day is concerned, just created
+            if pages.get(page) == 'created' and op == 'updated': continue
+            pages[page] = op
+
+        return [(date, by_date[date]) for date in dates]
@@ -0,0 +1,243 @@
+"""
+convert -- keep document conversion off the fork/exec path where we can
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import json
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.request
+
+import pypandoc
+
+
+class ConversionError(Exception): pass
+class ConversionTimeout(ConversionError): pass
+class BackendUnavailable(ConversionError): pass
+
+def pandoc_path():
+    if hasattr(pypandoc, 'get_pandoc_path'): return pypandoc.get_pandoc_path()
+    return shutil.which('pandoc') or 'pandoc'
+
+# run by pandoc's own Lua interpreter: reads "from to length" and the document from stdin, and writes back
+# "ok length" or "error length" and the result, until stdin is closed
+lua_loop = r'''
+while true do
+  local header = io.read('l')
+  if not header then break end
+  local from, to, length = header:match('^(%S+) (%S+) (%d+)$')
+  local text = length == '0' and '' or io.read(tonumber(length))
+  local ok, result = pcall(function() return pandoc.write(pandoc.read(text, from), to) end)
+  if not ok then result = tostring(result) end
+  io.write(ok and 'ok ' or 'error ', #result, '\n', result)
+  io.stdout:flush()
+end
+'''
+
+# one long-running `pandoc lua` process (pandoc 3 onwards) which converts any number of documents, so the
+# process and runtime startup is paid once rather than for every document
+class PandocLuaWorker:
+    def __init__(self):
+        try:
+            self.process = subprocess.Popen([pandoc_path(), 'lua', '-e', lua_loop], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as err:
+            raise BackendUnavailable('could not start pandoc: %s' % err)
+        # how many documents this worker has answered for, whether or not they converted
+        self.conversions = 0
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive: self.process.kill()
+
+    def convert(self, source, to, format, timeout):
+        data = source.encode('utf-8')
+        # a runaway conversion is killed, which also wakes us from the read below
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            self.kill()
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            self.process.stdin.write(('%s %s %d\n' % (format, to, len(data))).encode('utf-8') + data)
+            self.process.stdin.flush()
+            status, length = self.process.stdout.readline().decode('us-ascii').split()
+            result = self.process.stdout.read(int(length)).decode('utf-8')
+        except (OSError, ValueError):
+            if expired.is_set():
+                # so it's seen to be dead, and not handed out again
+                self.process.wait()
+                raise ConversionTimeout('conversion from %s to %s took longer than %ss' % (format, to, timeout))
+            # most likely a pandoc from before `pandoc lua`, which just exits
+            raise BackendUnavailable('the pandoc lua worker exited')
+        finally:
+            timer.cancel()
+        self.conversions += 1
+        if status != 'ok': raise ConversionError(result)
+        # the command line ends its output with a newline, and what's cached and indexed should be the same
+        return result if not result or result.endswith('\n') else result + '\n'
+
+# a pool of Lua workers, started as they're needed; a batch goes through one worker, one document after another
+class PandocLuaBackend:
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.available = True
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.alive: return worker
+            self.retire()
+
+        with self.lock:
+            start = self.started < self.workers
+            if start: self.started += 1
+        if not start:
+            try:
+                return self.idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise ConversionTimeout('no pandoc worker came free within %ss' % self.timeout)
+
+        try:
+            return PandocLuaWorker()
+        except BackendUnavailable:
+            # there's no pandoc to start at all
+            self.retire()
+            self.available = False
+            raise
+        except:
+            self.retire()
+            raise
+
+    def retire(self):
+        with self.lock:
+            self.started -= 1
+
+    def convert_many(self, sources, to, format):
+        results = []
+        worker = self.checkout()
+        while len(results) < len(sources):
+            try:
+                results.append(worker.convert(sources[len(results)], to, format, self.timeout))
+            except BackendUnavailable:
+                self.retire()
+                # a new worker which can't convert even one document is a pandoc from before `pandoc lua`; one
+                # that has converted before just died, so carry on with another
+                if not worker.conversions:
+                    self.available = False
+                    raise
+                worker = self.checkout()
+            except:
+                if worker.alive:
+                    self.idle.put(worker)
+                else:
+                    self.retire()
+                raise
+        
+        self.idle.put(worker)
+        return results
+
+# talks to a long-running pandoc server (`pandoc-server`), so there's no process startup per document
+class PandocServerBackend:
+    def __init__(self, url, timeout):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, path, payload):
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except OSError as err:
+            raise ConversionError('pandoc server at %r failed: %s' % (self.url, err))
+
+    def convert_many(self, sources, to, format):
+        results = self.request('/batch', [{'text': source, 'from': format, 'to': to} for source in sources])
+        return [self.output(result) for result in results]
+
+    def output(self, result):
+        if isinstance(result, str): return result
+        if 'error' in result: raise ConversionError(result['error'])
+        return result['output']
+
+# the last resort, for a pandoc too old for `pandoc lua`: one pandoc process per document, but with a bounded
+# number in flight
+class PandocProcessBackend:
+    def __init__(self, executor):
+        self.executor = executor
+
+    def submit(self, source, to, format):
+        return self.executor.submit(pypandoc.convert, source, to, format=format)
+
+class Converter:
+    def __init__(self, workers=4, queue_size=64, timeout=30, batch_size=100):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.processes = PandocProcessBackend(self.executor)
+        self.lua = PandocLuaBackend(workers, timeout)
+        self.server = None
+
+    def configure(self, config):
+        if config.get('pandoc_server'):
+            self.server = PandocServerBackend(config['pandoc_server'], self.timeout)
+        else:
+            self.server = None
+
+    # a batch is split between as many Lua workers as there are, each converting its share in one process
+    def convert_batched(self, sources, to, format):
+        size = -(-len(sources) // self.workers)
+        futures = [self.executor.submit(self.lua.convert_many, sources[start:start + size], to, format) for start in range(0, len(sources), size)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def convert(self, source, to, format):
+        return self.convert_many([source], to, format)[0]
+
+    def convert_many(self, sources, to, format):
+        sources = list(sources)
+        if not sources: return []
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise ConversionTimeout('conversion queue is full')
+        try:
+            if self.server:
+                results = []
+                for start in range(0, len(sources), self.batch_size):
+                    results.extend(self.server.convert_many(sources[start:start + self.batch_size], to, format))
+                return results
+
+            if self.lua.available:
+                try:
+                    return self.convert_batched(sources, to, format)
+                except BackendUnavailable as err:
+                    print('converting one document per pandoc process: %s' % err, file=sys.stderr)
+
+            futures = [self.processes.submit(source, to, format) for source in sources]
+            try:
+                return [future.result(timeout=self.timeout) for future in futures]
+            except FutureTimeoutError:
+                for future in futures: future.cancel()
+                raise ConversionTimeout('conversion from %s to %s took longer than %ss' % (format, to, self.timeout))
+        finally:
+            self.slots.release()
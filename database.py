@@ -1,78 +1,52 @@
-# TODO: implement this only in terms of storage, not using Git directly
 import os
 import os.path
-import time
 
 # common functionality for the search and links databases
 class Database:
+    moves_need_document = False
+    needs_documents = True
+    # on disk, so every worker process reads the same copy
+    shared = True
+    
     def __init__(self, site):
         self.site = site
 
     @property
     def path(self):
         return os.path.join(self.site.storage.repo.path, type(self).database_name) # come at me, Demeter!
-    
+
     @property
     def outdated(self):
+        return self.outdated_for(self.site.latest.revision)
+    
+    def outdated_for(self, revision):
         try:
-            with open(self.path + '.head', 'r', encoding='us-ascii') as f:
-                db_version = f.read().strip()
-                site_version = self.site.latest.revision
-                return db_version != site_version
+            return self.current_version != revision
         except FileNotFoundError:
             return True
-    
+
     @property
     def current_version(self):
         with open(self.path + '.head', 'r', encoding='us-ascii') as f:
             return f.read().strip()
+
+    # the revision readers are currently being served from
+    @property
+    def indexed_revision(self):
+        try:
+            return self.current_version
+        except FileNotFoundError:
+            return None
     
-    def update(self, tries=20):
+    def set_version(self, revision):
+        with open(self.path + '.head.new', 'w', encoding='us-ascii') as f:
+            print(revision, file=f)
+        os.rename(self.path + '.head.new', self.path + '.head')
+
+    # the diffing and rendering are shared between all the databases; see Indexer
+    def update(self):
+        # with a background updater running, or another process doing the indexing, readers just use whatever
+        # has been built so far
+        if self.site.indexer.background or self.site.indexer.passive: return
         if not self.outdated: return
-        try:
-            lock_file = None
-            try:
-                lock_file = open(self.path + '.head.lock', 'x', encoding='us-ascii') 
-                repo = self.site.storage.repo
-                
-                try:
-                    db_version = self.current_version
-                    
-                    print(db_version, file=lock_file)
-                    lock_file.flush()
-                    lock_file.seek(0)
-                
-                    old_tree = repo[repo[db_version].tree['pages'].id]
-                    new_tree = repo[repo[self.site.latest.revision].tree['pages'].id]
-                
-                    differences = {}
-                    for page in new_tree:
-                        if page.name not in old_tree:
-                            differences[page.name] = ('created', repo[page.id].data)
-                        elif old_tree[page.name].id != new_tree[page.name].id:
-                            differences[page.name] = ('updated', repo[page.id].data)
-                
-                    for page in old_tree:
-                        if page.name not in new_tree:
-                            differences[page.name] = ('deleted', None)
-                except FileNotFoundError:
-                    self.do_create()
-                    tree = repo[repo[self.site.latest.revision].tree['pages'].id]
-                    differences = {}
-                    for page in tree:
-                        differences[page.name] = ('created', repo[page.id].data)
-                
-                self.do_update(differences)
-                
-                print(self.site.latest.revision, file=lock_file)
-                lock_file.flush()
-            finally:
-                if lock_file and not lock_file.closed:
-                    lock_file.close()
-                os.rename(self.path + '.head.lock', self.path + '.head')
-        except FileExistsError:
-            if tries > 0:
-                time.sleep(0.1)
-                self.update(tries=tries - 1)
-            else:
-                raise
+        self.site.indexer.update()
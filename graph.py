@@ -0,0 +1,97 @@
+"""
+graph -- queries over the whole link graph: outlinks, orphans, wanted pages, and neighbourhoods
+"""
+from collections import deque
+import threading
+
+if "." in __name__:
+    from .util import filename_to_title, filename_to_url
+else:
+    from util import filename_to_title, filename_to_url
+
+
+def page_ref(filename):
+    return {'title': filename_to_title(filename), 'url': filename_to_url(filename)}
+
+# the links table and page list, held in memory as adjacency sets and rebuilt once per index revision
+class LinkSnapshot:
+    def __init__(self, pages, edges, redirects):
+        self.pages = pages
+        self.redirects = redirects
+        self.outlinks = {}
+        self.inlinks = {}
+        for source, target in edges:
+            # links to an alias are links to the page it leads to
+            target = redirects.get(target, target)
+            if target is None or target == source: continue
+            self.outlinks.setdefault(source, set()).add(target)
+            self.inlinks.setdefault(target, set()).add(source)
+        self._orphans = None
+        self._wanted = None
+
+    def orphans(self):
+        if self._orphans is None:
+            self._orphans = sorted(page for page in self.pages if page not in self.inlinks and page not in self.redirects and page != 'Homepage')
+        return self._orphans
+
+    def wanted(self):
+        if self._wanted is None:
+            wanted = [(target, len(sources)) for target, sources in self.inlinks.items() if target not in self.pages]
+            wanted.sort(key=lambda item: (-item[1], item[0]))
+            self._wanted = wanted
+        return self._wanted
+
+    def neighbours(self, filename, direction):
+        if direction in {'out', 'both'}: yield from self.outlinks.get(filename, ())
+        if direction in {'in', 'both'}: yield from self.inlinks.get(filename, ())
+
+    def neighbourhood(self, filename, hops, direction='both'):
+        distances = {filename: 0}
+        queue = deque([filename])
+        while queue:
+            page = queue.popleft()
+            if distances[page] == hops: continue
+            for neighbour in self.neighbours(page, direction):
+                if neighbour not in distances:
+                    distances[neighbour] = distances[page] + 1
+                    queue.append(neighbour)
+        del distances[filename]
+        return distances
+
+class LinkGraph:
+    def __init__(self, site, links, redirects):
+        self.site = site
+        self.links = links
+        self.redirects = redirects
+        self.version = None
+        self.snapshot = LinkSnapshot(set(), [], {})
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        self.links.update()
+        version = self.links.indexed_revision
+        if version == self.version: return self.snapshot
+
+        with self.lock:
+            if version == self.version: return self.snapshot
+            tree = self.site.indexer.pages_tree(version) if version is not None else None
+            pages = {entry.name for entry in tree} if tree is not None else set()
+            edges = self.links.conn.cursor().execute('SELECT source, target FROM links').fetchall()
+            self.redirects.refresh()
+            self.snapshot = LinkSnapshot(pages, edges, dict(self.redirects.targets))
+            self.version = version
+        return self.snapshot
+
+    def outlinks(self, filename):
+        snapshot = self.refresh()
+        return [dict(page_ref(target), exists=(target in snapshot.pages)) for target in sorted(snapshot.outlinks.get(filename, ()))]
+
+    def orphans(self):
+        return [page_ref(page) for page in self.refresh().orphans()]
+
+    def wanted(self):
+        return [dict(page_ref(target), count=count) for target, count in self.refresh().wanted()]
+
+    def neighbourhood(self, filename, hops=1, direction='both'):
+        distances = self.refresh().neighbourhood(filename, hops, direction)
+        return [dict(page_ref(page), distance=distance) for page, distance in sorted(distances.items(), key=lambda item: (item[1], item[0]))]
@@ -1,5 +1,5 @@
 from datetime import date
-import itertools
+import hashlib
 import mimetypes
 import os
 import os.path
@@ -7,56 +7,127 @@ from urllib.parse import urlparse, urljoin
 import yaml
 import random
 
-import bcrypt
 from jinja2 import Environment
-import pypandoc
+from werkzeug.wsgi import wrap_file
 
 # Save PEP 3122!
 if "." in __name__:
-    from .storage import Storage, Signature
-    from .util import url_to_title, url_to_filename, title_to_filename, filename_to_url, filename_to_title, sanitize_html, link_fix, StorageTemplateLoader
-    from .www import Application, Request, Response, JSONResponse
+    from .storage import Storage, Signature, RevisionWatcher
+    from .util import url_to_title, url_to_filename, title_to_filename, filename_to_url, filename_to_title, sanitize_html, link_fix, StorageTemplateLoader, storage_bytecode_cache
+    from .www import Application, Request, Response, JSONResponse, RedirectResponse
     from .search import LinksDatabase, SearchDatabase
+    from .changes import ChangesDatabase
+    from .redirects import RedirectResolver, source_redirect, follow_redirects
+    from .titles import TitleIndex
+    from .graph import LinkGraph
+    from .importer import Importer
+    from .auth import CredentialCache, SessionSigner
+    from .assets import Bundle
+    from .server import Server
+    from .cache import RenderCache, BlobFileCache, SearchCache
+    from .convert import Converter
+    from .indexer import Indexer
 else:
-    from storage import Storage, Signature
-    from util import url_to_title, url_to_filename, title_to_filename, filename_to_url, filename_to_title, sanitize_html, link_fix, StorageTemplateLoader
-    from www import Application, Request, Response, JSONResponse
+    from storage import Storage, Signature, RevisionWatcher
+    from util import url_to_title, url_to_filename, title_to_filename, filename_to_url, filename_to_title, sanitize_html, link_fix, StorageTemplateLoader, storage_bytecode_cache
+    from www import Application, Request, Response, JSONResponse, RedirectResponse
     from search import LinksDatabase, SearchDatabase
+    from changes import ChangesDatabase
+    from redirects import RedirectResolver, source_redirect, follow_redirects
+    from titles import TitleIndex
+    from graph import LinkGraph
+    from importer import Importer
+    from auth import CredentialCache, SessionSigner
+    from assets import Bundle
+    from server import Server
+    from cache import RenderCache, BlobFileCache, SearchCache
+    from convert import Converter
+    from indexer import Indexer
 
 
+class Snapshot:
+    def __init__(self, latest, config, config_id):
+        self.latest = latest
+        self.config = config
+        self.config_id = config_id
+        if 'base_url' in config:
+            self.base_url = config['base_url']
+            self.base_path = urlparse(self.base_url).path.rstrip('/')
+        else:
+            self.base_url = '/'
+            self.base_path = ''
+
 class Ikwi(Application):
     image_extensions = ['.jpg', '.png', '.svg', '.gif']
     version = '0.1'
+    # without the background updater, requests bring the indexes up to date themselves
+    background_indexing = True
     
     def __init__(self, repo_path):
         self.storage = Storage(repo_path)
-        
-        self.base_url = ''
-        self.base_path = ''
-        self.config = {}
-        self.config_revision = None
+        self.watcher = RevisionWatcher(self.storage)
+        self.snapshot = None
         self.jinja_env = Environment(
-            loader=StorageTemplateLoader(self.storage),
+            loader=StorageTemplateLoader(lambda: self.latest),
+            bytecode_cache=storage_bytecode_cache(self.storage),
             autoescape=True
         )
         self.jinja_env.globals = {
-            'site_url': self.site_url
+            'site_url': self.site_url,
+            'editor_js_url': self.editor_js_url
         }
         
-        self.links = LinksDatabase(self)
-        self.search = SearchDatabase(self)
+        self.indexer = Indexer(self)
+        self.links = self.indexer.register(LinksDatabase(self))
+        self.search = self.indexer.register(SearchDatabase(self))
+        self.changes = self.indexer.register(ChangesDatabase(self))
+        self.titles = self.indexer.register(TitleIndex(self))
+        self.redirects = RedirectResolver(self.links)
+        self.graph = LinkGraph(self, self.links, self.redirects)
+        self.render_cache = RenderCache(self)
+        self.blob_files = BlobFileCache(self)
+        self.search_cache = SearchCache(self)
+        self.converter = Converter()
+        self.editor_bundle = Bundle(os.path.join(os.path.dirname(__file__), 'js'), ['squire.js', 'jquery.js', 'underscore.js', 'editor.js'])
+        self.editor_bundle.current()
+        self.credentials = CredentialCache()
+        self.sessions = SessionSigner(os.path.join(self.storage.repo.path, 'session.key'))
 
     def before_request(self, request):
-        self.latest = self.storage.latest()
-        if self.latest.revision != self.config_revision:
-            self.config = yaml.load(self.latest.get('site.yaml').decode('utf-8'))
-            if 'base_url' in self.config:
-                self.base_url = self.config['base_url']
-                self.base_path = urlparse(self.base_url).path.rstrip('/')
-            else:
-                self.base_url = '/'
+        self.refresh()
+        self.start_indexing()
         request.path = request.path[len(self.base_path):]
 
+    def start_indexing(self):
+        if self.background_indexing and self.config.get('background_indexing', True):
+            self.indexer.start_background()
+
+    # requests only ever read the current snapshot; it's replaced wholesale when HEAD moves
+    def refresh(self):
+        latest = self.watcher.latest()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.latest.revision == latest.revision:
+            return snapshot
+        
+        config_id = latest.get_id('site.yaml')
+        if snapshot is not None and snapshot.config_id == config_id:
+            config = snapshot.config
+        else:
+            config = yaml.load(latest.get('site.yaml').decode('utf-8'))
+            self.converter.configure(config)
+        
+        self.snapshot = Snapshot(latest, config, config_id)
+        return self.snapshot
+
+    @property
+    def latest(self): return self.snapshot.latest
+    @property
+    def config(self): return self.snapshot.config if self.snapshot else {}
+    @property
+    def base_url(self): return self.snapshot.base_url if self.snapshot else ''
+    @property
+    def base_path(self): return self.snapshot.base_path if self.snapshot else ''
+
     def site_url(self, path=''):
         return urljoin(self.base_url, path)
 
@@ -85,21 +156,40 @@ class Ikwi(Application):
         elif base == 'site':
             self.require_method(request, ['GET'])
             if path == ['edit.js']:
-                js_dir = os.path.join(os.path.dirname(__file__), 'js')
-                js_files = ['squire.js', 'jquery.js', 'underscore.js', 'editor.js']
-                def js_gen():
-                    for js_filename in js_files:
-                        with open(os.path.join(js_dir, js_filename), 'rb') as file:
-                            yield from file
-                            yield b'\n'
-            
-                response = Response(js_gen(), mimetype='application/javascript')
-                #response.set_etag(Ikwi.version)
-                #response.make_conditional(request)
-                return response
+                return self.serve_bundle(self.editor_bundle, request)
             elif path == ['search']:
-                results = self.search.search(request.args['q'])
-                return JSONResponse({'query': request.args['q'], 'results': results})
+                if 'wait' in request.args:
+                    self.indexer.wait_for(request.args['wait'], timeout=10)
+                try:
+                    page = max(int(request.args.get('page', 1)), 1)
+                    pagelen = min(max(int(request.args.get('pagelen', 30)), 1), 100)
+                except ValueError:
+                    page, pagelen = 1, 30
+                results = self.search.search(request.args['q'], page=page, pagelen=pagelen)
+                results.update({'query': request.args['q'], 'revision': self.search.indexed_revision})
+                return JSONResponse(results)
+            elif path == ['complete']:
+                prefix = request.args.get('prefix', '')
+                return JSONResponse({'prefix': prefix, 'results': self.titles.complete(prefix)})
+            elif path == ['orphans']:
+                return JSONResponse({'revision': self.links.indexed_revision, 'results': self.graph.orphans()})
+            elif path == ['wanted']:
+                return JSONResponse({'revision': self.links.indexed_revision, 'results': self.graph.wanted()})
+            elif path == ['outlinks'] and 'page' in request.args:
+                filename = url_to_filename(request.args['page'])
+                return JSONResponse({'page': request.args['page'], 'revision': self.links.indexed_revision, 'results': self.graph.outlinks(filename)})
+            elif path == ['neighbourhood'] and 'page' in request.args:
+                filename = url_to_filename(request.args['page'])
+                try:
+                    hops = min(max(int(request.args.get('hops', 1)), 1), 5)
+                except ValueError:
+                    hops = 1
+                direction = request.args.get('direction', 'both')
+                if direction not in {'in', 'out', 'both'}: direction = 'both'
+                results = self.graph.neighbourhood(filename, hops=hops, direction=direction)
+                return JSONResponse({'page': request.args['page'], 'hops': hops, 'direction': direction, 'revision': self.links.indexed_revision, 'results': results})
+            elif path == ['search-stats']:
+                return JSONResponse(self.search_cache.stats())
             elif path == ['recent']:
                 return self.show_recent_changes(request)
             else:
@@ -111,14 +201,16 @@ class Ikwi(Application):
             url_page_name = (base or 'Homepage')
             if request.method == 'GET':
                 if request.query_verb == 'old':
-                    return self.show_page(url_page_name, self.storage.at_revision(request.args['rev']))
+                    return self.show_page(url_page_name, self.storage.at_revision(request.args['rev']), request)
                 elif request.query_verb == 'edit':
                     self.must_login(request)
                     return self.edit_page(url_page_name)
                 elif request.query_verb == 'inlinks':
+                    if 'wait' in request.args:
+                        self.indexer.wait_for(request.args['wait'], timeout=10)
                     return self.show_inlinks(url_page_name)
                 elif request.query_verb in {None, 'no-redirect'}:
-                    return self.show_page(url_page_name, self.latest)
+                    return self.show_page(url_page_name, self.latest, request, follow_redirects=(request.query_verb is None))
                 else:
                     return self.not_found()
             elif request.method == 'POST':
@@ -126,13 +218,16 @@ class Ikwi(Application):
                 return self.save_page(url_page_name, request)
 
     def to_html(self, source, fix_links=False):
-        html = pypandoc.convert(source, 'html', format=self.config['page_format'])
+        return self.to_html_many([source], fix_links=fix_links)[0]
+    def to_html_many(self, sources, fix_links=False):
+        sources = [source.decode('utf-8') if isinstance(source, bytes) else source for source in sources]
+        htmls = self.converter.convert_many(sources, 'html', self.config['page_format'])
         if fix_links:
-            return link_fix(html, fix=self.site_url)
+            return [link_fix(html, fix=self.site_url) for html in htmls]
         else:
-            return html
+            return htmls
     def to_source(self, html):
-        return pypandoc.convert(html, self.config['page_format'], format='html')
+        return self.converter.convert(html, self.config['page_format'], 'html')
 
     def get_page(self, url_page_name, revision):
         pages = revision.dir('pages')
@@ -142,30 +237,93 @@ class Ikwi(Application):
         else:
             return None
 
-    def header_image(self, page_filename, revision):
-        if revision.revision != self.latest.revision:
-            old_string = '?old&rev=%s' % revision.revision
+    def get_page_id(self, url_page_name, revision):
+        pages = revision.dir('pages')
+        filename = url_to_filename(url_page_name)
+        if filename in pages:
+            return pages.get_id(filename)
         else:
-            old_string = ''
+            return None
+
+    def render_page(self, url_page_name, revision):
+        page_id = self.get_page_id(url_page_name, revision)
+        if not page_id: return None
         
+        return self.render_cache.render(page_id, self.config['page_format'], self.base_url,
+            lambda: self.to_html(self.get_page(url_page_name, revision), fix_links=True))
+
+    def header_image_filename(self, page_filename, revision):
         images = revision.dir('images')
         for extension in Ikwi.image_extensions:
             image_filename = page_filename + extension
             if image_filename in images:
-                return self.site_url('images/' + image_filename + old_string)
+                return image_filename
 
-    def show_page(self, url_page_name, revision):
+    def header_image(self, page_filename, revision):
+        if revision.revision != self.latest.revision:
+            old_string = '?old&rev=%s' % revision.revision
+        else:
+            old_string = ''
+        
+        image_filename = self.header_image_filename(page_filename, revision)
+        if image_filename:
+            return self.site_url('images/' + image_filename + old_string)
+
+    # everything that goes into a rendered page, so the tag changes whenever the page could
+    def page_etag(self, page_id, revision, page_filename):
+        image_filename = self.header_image_filename(page_filename, revision)
+        parts = [
+            Ikwi.version,
+            page_id,
+            self.latest.get_id('templates') if 'templates' in self.latest.entries else '',
+            revision.dir('images').get_id(image_filename) if image_filename else '',
+            self.latest.get_id('site.yaml'),
+            # the header image link of an old revision points at that revision
+            revision.revision if revision.revision != self.latest.revision and image_filename else ''
+        ]
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def redirect_target(self, url_page_name):
+        # the page being served decides whether it's a redirect, since the index may not have caught up with it
+        pages = self.latest.dir('pages')
+        filename = url_to_filename(url_page_name)
+        target = source_redirect(pages.get(filename))
+        if target is None: return None
+        
+        # the index has already followed any chain of redirects from here, which is worth using if it agrees
+        # about the first step; otherwise follow the sources, which are cheaper to read than a page is to render
+        if self.redirects.direct_target(filename) == target:
+            return self.redirects.resolve(filename)
+        return follow_redirects(filename, lambda page: source_redirect(pages.get(page)))
+    
+    def show_page(self, url_page_name, revision, request, follow_redirects=False):
         page_title = url_to_title(url_page_name)
-        page_source = self.get_page(url_page_name, revision)
+        page_filename = url_to_filename(url_page_name)
+        page_id = self.get_page_id(url_page_name, revision)
         
-        if not page_source:
+        if page_id is None:
             return self.not_found(creatable=True)
         
-        page_content = self.to_html(page_source, fix_links=True)
-        header_image = self.header_image(url_to_filename(url_page_name), revision)
+        if follow_redirects:
+            target = self.redirect_target(url_page_name)
+            if target and target != page_filename:
+                return RedirectResponse(self.site_url(target))
+        
+        etag = self.page_etag(page_id, revision, page_filename)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            page_content = self.render_page(url_page_name, revision)
+            header_image = self.header_image(page_filename, revision)
+            response = self.render_template('page.html', page_title=page_title, page_content=page_content, header_image=header_image)
         
-        response = self.render_template('page.html', page_title=page_title, page_content=page_content, header_image=header_image)
-        # todo: make response cacheable
+        response.set_etag(etag)
+        if revision.revision != self.latest.revision:
+            # a historical revision can never change
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        response.make_conditional(request)
         return response
     
     def edit_page(self, url_page_name):
@@ -186,7 +344,7 @@ class Ikwi(Application):
         html = sanitize_html(request.form['content'])
         filename = title_to_filename(title)
         
-        cursor = self.storage.cursor(request.form['revision'])
+        cursor = self.storage.cursor(request.form['revision'], staged=True)
         cursor.add('pages/' + filename, self.to_source(html).encode('utf-8'))
         
         if 'headerimage' in request.files:
@@ -201,9 +359,12 @@ class Ikwi(Application):
                 
                 cursor.add('images/' + image_filename, header_image)
             
-        cursor.save('%s: %s' % (title, request.form.get('change_message', '')), Signature(self.config['editors'][request.authorization.username]['name'], self.config['editors'][request.authorization.username]['email']))
+        cursor.save('%s: %s' % (title, request.form.get('change_message', '')), Signature(self.config['editors'][request.editor]['name'], self.config['editors'][request.editor]['email']))
         status = cursor.update('HEAD')
         
+        if self.indexer.background:
+            self.indexer.background.poke()
+        
         if status.conflict:
             return JSONResponse({
                 'status': 'conflict',
@@ -216,43 +377,55 @@ class Ikwi(Application):
     def show_inlinks(self, url_page_name):
         page_title = url_to_title(url_page_name)
         filename = url_to_filename(url_page_name)
-        inlinks = self.links.inlinks(filename)
-        return self.render_template('inlinks.html', inlinks=inlinks, page_title=page_title, page_url=url_page_name)
-
-    def generate_recent_changes(self):
-        def date_group(revinfo):
-            time, revision = revinfo
-            return date(*time.timetuple()[:3])
-        
-        revision = None
-        revision_date = None
-        for prev_revision_date, prev_revision in itertools.islice(itertools.groupby(self.storage.history(), key=date_group), 31):
-            prev_revision = [r for dt, r in prev_revision]
-            if revision is None:
-                revision = prev_revision
-                revision_date = prev_revision_date
-                continue
-            
-            diffs = revision[0].dir('pages').diff_files(prev_revision[0].dir('pages'))
-            if len(diffs) != 0:
-                yield revision_date, diffs
-            
-            revision = prev_revision
-            revision_date = prev_revision_date
+        # links to any of a page's aliases are links to the page too
+        inlinks = self.links.inlinks(filename, aliases=self.redirects.aliases_of(filename))
+        return self.render_template('inlinks.html', inlinks=inlinks, page_title=page_title, page_url=url_page_name, indexed_revision=self.links.indexed_revision)
 
     def show_recent_changes(self, request):
+        days = 31
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        
+        recent = self.changes.recent(days=days, offset=(page - 1) * days)
         def format_recent_changes():
             def link(file):
                 return {'url': file, 'title': filename_to_title(file)}
             
-            for date, changes in self.generate_recent_changes():
+            for day, changes in recent:
                 yield {
-                    'date': date,
-                    'updated': sorted((link(file) for file, op in changes.items() if op[0] == 'updated'), key=lambda x: x['title']),
-                    'created': sorted((link(file) for file, op in changes.items() if op[0] == 'created'), key=lambda x: x['title'])
+                    'date': date(*map(int, day.split('-'))),
+                    'updated': sorted((link(file) for file, op in changes.items() if op == 'updated'), key=lambda x: x['title']),
+                    'created': sorted((link(file) for file, op in changes.items() if op == 'created'), key=lambda x: x['title'])
                 }
         
-        return self.render_template('recent.html', changes=format_recent_changes())
+        return self.render_template('recent.html', changes=format_recent_changes(), page=page,
+            next_page=(page + 1 if len(recent) == days else None), previous_page=(page - 1 if page > 1 else None))
+
+    def serve_bundle(self, bundle, request):
+        built = bundle.current()
+        encoding = bundle.choose_encoding(request, built)
+        etag = built.etag(encoding)
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(built.encodings[encoding], mimetype='application/javascript')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if request.args.get('v') == built.hash:
+            # a versioned URL will never serve anything else
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=3600'
+        return response
+    
+    def editor_js_url(self):
+        return self.site_url('site/edit.js?v=' + self.editor_bundle.current().hash)
 
     def serve_file(self, path, request):
         path = path[0]
@@ -260,41 +433,104 @@ class Ikwi(Application):
         if path not in dir:
             return self.not_found()
         
-        type, encoding = mimetypes.guess_type(path)
-        
-        # prevent the blob from being decoded unless actually needed
-        def yield_get(): yield dir.get(path)
-        response = Response(yield_get(), mimetype=type, direct_passthrough=True)
-        response.set_etag(dir.get_id(path))
-        response.make_conditional(request)
-        return response
+        return self.serve_blob(dir, path, request)
     
     def serve_image(self, path, revision, request):
         path = url_to_filename(path)
-        dir = self.latest.dir('images')
+        dir = revision.dir('images')
         if path not in dir:
             return self.not_found()
+        
+        return self.serve_blob(dir, path, request)
+    
+    def serve_blob(self, dir, path, request, chunk_size=64 * 1024):
         type, encoding = mimetypes.guess_type(path)
+        blob_id = dir.get_id(path)
         
-        # prevent the blob from being decoded unless actually needed
-        def yield_get(): yield dir.get(path)
-        response = Response(yield_get(), mimetype=type, direct_passthrough=True)
-        response.set_etag(dir.get_id(path))
-        response.make_conditional(request)
+        if request.if_none_match.contains(blob_id):
+            response = Response(status=304)
+            response.set_etag(blob_id)
+            return response
+        
+        # large blobs are sent from a copy on disk; everything else comes out of git (or the object cache)
+        spilled = self.blob_files.lookup(blob_id)
+        if not spilled:
+            data = dir.get(path)
+            spilled = self.blob_files.store(blob_id, data)
+        if spilled:
+            length = os.path.getsize(spilled)
+        else:
+            length = len(data)
+        
+        start, stop = 0, length
+        status = 200
+        byte_range = request.range
+        # If-Range means "only if it's still the version I have"; otherwise fall back to the whole thing
+        if byte_range and ('If-Range' not in request.headers or request.if_range.etag == blob_id):
+            # multiple ranges, or ones we can't satisfy, get the whole thing too, which is always allowed
+            range_for_length = byte_range.range_for_length(length) if byte_range.units == 'bytes' and len(byte_range.ranges) == 1 else None
+            if range_for_length is not None:
+                start, stop = range_for_length
+                status = 206
+        
+        def chunks():
+            if spilled:
+                with open(spilled, 'rb') as f:
+                    f.seek(start)
+                    remaining = stop - start
+                    while remaining > 0:
+                        chunk = f.read(min(chunk_size, remaining))
+                        if not chunk: break
+                        remaining -= len(chunk)
+                        yield chunk
+            else:
+                view = memoryview(data)
+                for offset in range(start, stop, chunk_size):
+                    yield bytes(view[offset:min(offset + chunk_size, stop)])
+        
+        if spilled and status == 200:
+            # lets the server use sendfile() when it can
+            body = wrap_file(request.environ, open(spilled, 'rb'), chunk_size)
+        else:
+            body = chunks()
+        
+        response = Response(body, status, mimetype=type, direct_passthrough=True)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+        response.set_etag(blob_id)
         return response
 
     def must_login(self, request):
+        editors = self.config['editors']
+        
+        token = request.cookies.get(SessionSigner.cookie_name)
+        if token:
+            username = self.sessions.verify(token, editors)
+            if username:
+                request.editor = username
+                return
+        
         if not request.authorization:
             raise PermissionError
         
         username = request.authorization.username
         try_password = request.authorization.password.encode('utf-8')
-        if username not in self.config['editors']:
+        if username not in editors:
             raise PermissionError
         
-        real_password = self.config['editors'][username]['password'].encode('utf-8')
-        if bcrypt.hashpw(try_password, real_password) != real_password:
+        if not self.credentials.check(username, try_password, editors[username]):
             raise PermissionError
+        
+        request.editor = username
+        # from now on the cookie will do, and bcrypt can stay out of it
+        request.new_session = self.sessions.issue(username, editors[username])
+    
+    def after_request(self, request, response):
+        if getattr(request, 'new_session', None):
+            response.set_cookie(SessionSigner.cookie_name, request.new_session, max_age=self.sessions.lifetime, path=(self.base_path or '/'), httponly=True, samesite='Lax', secure=request.is_secure)
+        return response
     
     def unauthorized(self):
         response = self.render_template('unauthorized.html')
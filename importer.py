@@ -0,0 +1,140 @@
+"""
+importer -- load a large set of existing pages in a handful of commits rather than one per page
+"""
+import os
+import os.path
+import sys
+import tarfile
+import zipfile
+
+if "." in __name__:
+    from .storage import Signature
+    from .util import title_to_filename
+else:
+    from storage import Signature
+    from util import title_to_filename
+
+
+# pandoc reader names for the file extensions we know about
+formats = {
+    '.md': 'markdown',
+    '.markdown': 'markdown',
+    '.html': 'html',
+    '.htm': 'html',
+    '.rst': 'rst',
+    '.textile': 'textile',
+    '.org': 'org',
+    '.wiki': 'mediawiki',
+    '.mediawiki': 'mediawiki',
+    '.tex': 'latex',
+}
+
+def page_name(path):
+    name, extension = os.path.splitext(os.path.basename(path))
+    return name, extension.lower()
+
+# yields (name, extension, contents) for every page in a directory, zip file or tarball, one at a time
+def read_pages(source):
+    if os.path.isdir(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.startswith('.'): continue
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    yield page_name(filename) + (f.read(),)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/') or os.path.basename(info.filename).startswith('.'): continue
+                yield page_name(info.filename) + (archive.read(info),)
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if not member.isfile() or os.path.basename(member.name).startswith('.'): continue
+                yield page_name(member.name) + (archive.extractfile(member).read(),)
+    else:
+        raise ValueError('%r is not a directory or an archive ikwi can read' % source)
+
+class Importer:
+    def __init__(self, site, *, source_format=None, batch_size=100, chunk_size=None, author=None, message='Import pages', progress=True):
+        self.site = site
+        self.source_format = source_format
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.author = author or Signature('ikwi', 'ikwi@localhost')
+        self.message = message
+        self.progress = progress
+
+    def reader_for(self, extension):
+        page_format = self.site.config['page_format']
+        return self.source_format or formats.get(extension, page_format)
+
+    # a page is anything with an extension we know, or none at all; images and the like are left out
+    def is_page(self, extension):
+        return extension == '' or extension in formats
+
+    # each batch goes through the converter together, which runs pandoc for the whole batch in parallel
+    def convert(self, batch):
+        page_format = self.site.config['page_format']
+        by_format = {}
+        for name, extension, contents in batch:
+            if not self.is_page(extension):
+                print('skipping %s%s: not a page format ikwi knows' % (name, extension), file=sys.stderr)
+                continue
+            try:
+                contents = contents.decode('utf-8')
+            except UnicodeDecodeError:
+                print('skipping %s%s: not UTF-8 text' % (name, extension), file=sys.stderr)
+                continue
+            by_format.setdefault(self.reader_for(extension), []).append((name, contents))
+
+        for reader, pages in by_format.items():
+            if reader == page_format:
+                yield from pages
+            else:
+                converted = self.site.converter.convert_many([contents for name, contents in pages], page_format, reader)
+                yield from zip((name for name, contents in pages), converted)
+
+    def run(self, source):
+        storage = self.site.storage
+        cursor = storage.cursor(storage.latest().revision, staged=True)
+
+        count = 0
+        chunk = 0
+        batch = []
+        # pages are named after files, not their directories, so two files can turn out to be the same page
+        imported = set()
+        def flush_batch():
+            nonlocal count, chunk
+            for name, contents in self.convert(batch):
+                filename = title_to_filename(name.replace('_', ' '))
+                if filename in imported:
+                    print('skipping another file for %s: a page by that name has already been imported' % name, file=sys.stderr)
+                    continue
+                imported.add(filename)
+                # blobs go straight into the object database; the tree is only built when a chunk is saved
+                cursor.add('pages/' + filename, contents.encode('utf-8'))
+                count += 1
+                chunk += 1
+                if self.chunk_size and chunk >= self.chunk_size:
+                    cursor.save('%s (%d pages)' % (self.message, count), self.author)
+                    chunk = 0
+            if self.progress:
+                print('imported %d pages' % count, file=sys.stderr)
+            batch.clear()
+
+        for page in read_pages(source):
+            batch.append(page)
+            if len(batch) >= self.batch_size: flush_batch()
+        if batch: flush_batch()
+
+        if cursor.pending or chunk:
+            cursor.save('%s (%d pages)' % (self.message, count), self.author)
+        status = cursor.update('HEAD')
+        if status.conflict:
+            raise RuntimeError('the import conflicts with changes made while it was running')
+
+        # and bring every index up to date in one parallel pass
+        self.site.refresh()
+        self.site.indexer.update(status.revision, parallel=True)
+        return status.revision, count
@@ -0,0 +1,338 @@
+"""
+indexer -- diff, render and parse changed pages once, and feed the results to every index
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import threading
+import time
+import traceback
+
+import lxml.html.html5parser as html5
+import pygit2
+
+if "." in __name__:
+    from .convert import Converter
+    from .locking import FileLock
+    from .util import url_to_filename
+else:
+    from convert import Converter
+    from locking import FileLock
+    from util import url_to_filename
+
+
+ns = {'h':'http://www.w3.org/1999/xhtml'}
+
+class PageDocument:
+    def __init__(self, page, redirect_to=None, links=(), text=''):
+        self.page = page
+        self.redirect_to = redirect_to
+        self.links = set(links)
+        self.text = text
+
+def analyze_html(page, html, base_url):
+    src = html5.fragment_fromstring(html, create_parent='div')
+
+    links = set()
+    for link in src.xpath('//h:a[@href]', namespaces=ns):
+        dest = link.attrib['href']
+        if dest.startswith('wiki:'):
+            links.add(url_to_filename(dest[5:]))
+        elif dest.rstrip('/') == base_url.rstrip('/'):
+            links.add('Homepage')
+
+    return PageDocument(page, links=links, text=' '.join(src.xpath('//text()')))
+
+def analyze_sources(sources, page_format, base_url, convert_many):
+    documents = {}
+    to_render = []
+    for page, content in sources:
+        content = content.decode('utf-8')
+        if content.startswith('=> '):
+            documents[page] = PageDocument(page, redirect_to=content[3:].strip())
+        else:
+            to_render.append((page, content))
+
+    htmls = convert_many([content for page, content in to_render], 'html', page_format)
+    for (page, content), html in zip(to_render, htmls):
+        documents[page] = analyze_html(page, html, base_url)
+
+    return documents
+
+# runs in a worker process, so it gets its own converter rather than the site's; it's kept for the life of the
+# process, so every batch goes through the same warm pandoc
+worker_converter = None
+def analyze_batch(sources, page_format, base_url, config):
+    global worker_converter
+    if worker_converter is None: worker_converter = Converter(workers=1)
+    worker_converter.configure(config)
+    return analyze_sources(sources, page_format, base_url, worker_converter.convert_many)
+
+def print_progress(done, total):
+    print('indexed %d of %d pages' % (done, total), file=sys.stderr)
+
+def index_workers(site):
+    return site.config.get('index_workers') or os.cpu_count() or 1
+
+class Change:
+    def __init__(self, page, op, blob_id=None, old_page=None):
+        self.page = page
+        self.op = op
+        self.blob_id = blob_id
+        self.old_page = old_page
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch: yield batch
+
+class Indexer:
+    # a passive indexer leaves the shared indexes to another process, and only reads them; it still keeps the
+    # ones in its own memory up to date
+    def __init__(self, site, batch_size=50, passive=False, poll_interval=0.2):
+        self.site = site
+        self.batch_size = batch_size
+        self.passive = passive
+        self.poll_interval = poll_interval
+        self.consumers = []
+        self.background = None
+        self.indexed = threading.Condition()
+        self.local_lock = threading.Lock()
+    
+    @property
+    def lock_path(self):
+        return os.path.join(self.site.storage.repo.path, 'index.lock')
+    
+    def register(self, consumer):
+        self.consumers.append(consumer)
+        return consumer
+    
+    # the consumers this process is responsible for keeping up to date
+    @property
+    def maintained(self):
+        if not self.passive: return self.consumers
+        return [consumer for consumer in self.consumers if not consumer.shared]
+    
+    def pages_tree(self, version):
+        repo = self.site.storage.repo
+        tree = repo[version].tree
+        if 'pages' not in tree: return None
+        return repo[tree['pages'].id]
+    
+    def changes(self, old_version, new_version):
+        new_tree = self.pages_tree(new_version)
+        
+        if old_version is None:
+            if new_tree is None: return
+            for entry in new_tree:
+                yield Change(entry.name, 'created', entry.id)
+            return
+        
+        old_tree = self.pages_tree(old_version)
+        if old_tree is None or new_tree is None:
+            # libgit2 can't diff against a missing tree, so fall back to listing whatever's there
+            for entry in (old_tree or ()):
+                yield Change(entry.name, 'deleted')
+            for entry in (new_tree or ()):
+                yield Change(entry.name, 'created', entry.id)
+            return
+        
+        diff = old_tree.diff_to_tree(new_tree)
+        diff.find_similar(pygit2.GIT_DIFF_FIND_RENAMES)
+        for patch in diff:
+            delta = patch.delta
+            if delta.status == pygit2.GIT_DELTA_ADDED:
+                yield Change(delta.new_file.path, 'created', delta.new_file.id)
+            elif delta.status == pygit2.GIT_DELTA_MODIFIED:
+                yield Change(delta.new_file.path, 'updated', delta.new_file.id)
+            elif delta.status == pygit2.GIT_DELTA_DELETED:
+                yield Change(delta.old_file.path, 'deleted')
+            elif delta.status == pygit2.GIT_DELTA_RENAMED:
+                if delta.old_file.id == delta.new_file.id:
+                    yield Change(delta.new_file.path, 'moved', delta.new_file.id, old_page=delta.old_file.path)
+                else:
+                    yield Change(delta.old_file.path, 'deleted')
+                    yield Change(delta.new_file.path, 'created', delta.new_file.id)
+    
+    def needs_document(self, change, consumers):
+        if change.op == 'deleted': return False
+        if not any(consumer.needs_documents for consumer in consumers): return False
+        if change.op == 'moved': return any(consumer.moves_need_document for consumer in consumers)
+        return True
+    
+    # blobs are only loaded a batch at a time, so memory use doesn't grow with the size of the wiki
+    def sources(self, batch, consumers):
+        repo = self.site.storage.repo
+        return [(change.page, repo[change.blob_id].data) for change in batch if self.needs_document(change, consumers)]
+    
+    def analyzed_batches(self, changes, consumers, parallel=False, total=None, progress=print_progress):
+        page_format = self.site.config['page_format']
+        base_url = self.site.base_url
+        workers = index_workers(self.site)
+        
+        if not any(consumer.needs_documents for consumer in consumers):
+            # e.g. the title index by itself: there's nothing to render, so no call for a process pool either
+            for batch in batched(changes, self.batch_size):
+                yield batch, {}
+            return
+        
+        if not parallel or workers == 1:
+            for batch in batched(changes, self.batch_size):
+                yield batch, analyze_sources(self.sources(batch, consumers), page_format, base_url, self.site.converter.convert_many)
+            return
+        
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for batch in batched(changes, self.batch_size):
+                pending.append((batch, pool.submit(analyze_batch, self.sources(batch, consumers), page_format, base_url, self.site.config)))
+                # keep a bounded number of batches in flight
+                while len(pending) > workers * 2:
+                    batch, future = pending.pop(0)
+                    done += len(batch)
+                    yield batch, future.result()
+                    if progress: progress(done, total)
+            
+            for batch, future in pending:
+                done += len(batch)
+                yield batch, future.result()
+                if progress: progress(done, total)
+    
+    def update(self, latest=None, parallel=False):
+        if latest is None: latest = self.site.latest.revision
+        maintained = self.maintained
+        if not any(consumer.outdated_for(latest) for consumer in maintained): return
+        
+        # if another process is already indexing we sleep in the kernel until it's done, then find there's
+        # (usually) nothing left to do; a passive indexer only touches its own memory, so a thread lock will do
+        with (self.local_lock if self.passive else FileLock(self.lock_path)):
+            # consumers which are at the same revision share one diff and one rendering of each page
+            groups = {}
+            for consumer in maintained:
+                if not consumer.outdated_for(latest): continue
+                try:
+                    version = consumer.current_version
+                except FileNotFoundError:
+                    version = None
+                groups.setdefault(version, []).append(consumer)
+            
+            for version, consumers in groups.items():
+                self.update_consumers(consumers, version, latest, parallel=parallel)
+        
+        with self.indexed:
+            self.indexed.notify_all()
+    
+    def is_indexed(self, revision):
+        repo = self.site.storage.repo
+        for consumer in self.consumers:
+            try:
+                version = consumer.current_version
+            except FileNotFoundError:
+                return False
+            if version != revision and not repo.descendant_of(version, revision):
+                return False
+        return True
+    
+    # the revision comes from the client, so anything which isn't a commit the site has already seen is clamped
+    # to the site's latest revision: a request never gets to choose what is indexed
+    def wait_target(self, revision):
+        repo = self.site.storage.repo
+        latest = self.site.latest.revision
+        try:
+            commit = repo.get(revision)
+        except (KeyError, ValueError, TypeError):
+            return latest
+        if not isinstance(commit, pygit2.Commit): return latest
+        
+        revision = str(commit.id)
+        if revision != latest and not repo.descendant_of(latest, revision): return latest
+        return revision
+    
+    # for callers which need to read their own writes
+    def wait_for(self, revision, timeout=None):
+        revision = self.wait_target(revision)
+        if self.background is None:
+            self.update()
+            if not self.passive: return True
+        else:
+            self.background.poke()
+            if not self.passive:
+                with self.indexed:
+                    return self.indexed.wait_for(lambda: self.is_indexed(revision), timeout)
+        
+        # the shared indexes are written by another process, which can't wake us, so look every so often
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_indexed(revision):
+            if deadline is not None and time.monotonic() >= deadline: return False
+            time.sleep(self.poll_interval)
+        return True
+    
+    def start_background(self, interval=5):
+        if self.background is None:
+            self.background = BackgroundUpdater(self, interval)
+            self.background.start()
+        return self.background
+    
+    def stop_background(self):
+        if self.background is not None:
+            self.background.stop()
+            self.background = None
+    
+    def update_consumers(self, consumers, version, latest, parallel=False):
+        rebuilding = version is None
+        changes = self.changes(version, latest)
+        total = None
+        if rebuilding or parallel:
+            if rebuilding:
+                for consumer in consumers: consumer.do_create()
+            # progress is reported against what's actually changing, not the size of the whole wiki; the changes
+            # themselves are small, it's only their blobs which are loaded a batch at a time
+            changes = list(changes)
+            total = len(changes)
+        
+        for consumer in consumers: consumer.do_begin(rebuilding=rebuilding, revision=latest)
+        try:
+            for batch, documents in self.analyzed_batches(changes, consumers, parallel=(rebuilding or parallel), total=total):
+                for change in batch:
+                    document = documents.get(change.page)
+                    for consumer in consumers:
+                        consumer.do_apply(change, document)
+        except:
+            for consumer in consumers: consumer.do_abort()
+            raise
+        
+        for consumer in consumers:
+            consumer.do_commit()
+            consumer.set_version(latest)
+
+# keeps the indexes following HEAD, so that readers never have to wait for a reindex
+class BackgroundUpdater(threading.Thread):
+    def __init__(self, indexer, interval):
+        super().__init__(name='ikwi index updater', daemon=True)
+        self.indexer = indexer
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopping = False
+    
+    def poke(self):
+        self.wake.set()
+    
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        self.join()
+    
+    def run(self):
+        while not self.stopping:
+            try:
+                # the updater may be running before any request has come in, so it keeps the snapshot current itself
+                self.indexer.update(self.indexer.site.refresh().latest.revision)
+            except Exception:
+                traceback.print_exc()
+            
+            self.wake.wait(self.interval)
+            self.wake.clear()
@@ -124,7 +124,7 @@ $(function() {
             }
             var urlRegexp = /^[a-z][a-z-]*:\S/;
             var doSearch = function(query) {
-                $.ajax({dataType: 'json', url: 'site/search', data: {q: query}, success: function(data) {
+                $.ajax({dataType: 'json', url: 'site/complete', data: {prefix: query}, success: function(data) {
                     if (search.val() !== query) { return; }
                     
                     results.empty();
@@ -148,7 +148,7 @@ $(function() {
             };
             
             doSearch(text);
-            doSearch = _.throttle(doSearch, 500, {leading: false});
+            doSearch = _.throttle(doSearch, 100, {leading: false});
             
             dialog.html('<h3>Insert Link</h3>');
             search.val(text);
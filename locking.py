@@ -0,0 +1,77 @@
+"""
+locking -- advisory inter-process locks which can't be left behind by a crashed process
+"""
+import fcntl
+import os
+import time
+
+
+class LockTimeout(Exception): pass
+
+# the lock is held on an open file description, not on the file's existence, so the kernel releases it
+# when its holder exits for whatever reason, and anyone blocked in flock() is woken up straight away
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def acquire(self, blocking=True, timeout=None):
+        if self.locked: raise RuntimeError('lock on %r is already held' % self.path)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if blocking and timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline = time.monotonic() + (timeout or 0)
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not blocking or time.monotonic() >= deadline:
+                            raise LockTimeout('could not lock %r; it is held by process %s' % (self.path, self.holder()))
+                        time.sleep(0.05)
+        except:
+            os.close(fd)
+            raise
+
+        # record who we are, for the benefit of anyone debugging a long wait
+        os.ftruncate(fd, 0)
+        os.write(fd, ('%d\n' % os.getpid()).encode('us-ascii'))
+        self.fd = fd
+        return True
+
+    def release(self):
+        if not self.locked: return
+        fd, self.fd = self.fd, None
+        # the file itself stays: unlinking it would let two processes lock different inodes under the same name
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def holder(self):
+        try:
+            with open(self.path, 'r', encoding='us-ascii') as f:
+                pid = int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # a pid left in the file by a process which has since died is stale, and isn't holding anything
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return pid
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,45 @@
+"""
+pagerank -- power iteration over the links graph
+"""
+
+# edges is an iterable of (source, target) pairs; previous, if given, is the last set of ranks, which makes a
+# good starting guess after a small edit, so it usually converges in a handful of iterations instead of dozens
+def pagerank(edges, previous=None, damping=0.85, tolerance=1.0e-6, max_iterations=100):
+    outlinks = {}
+    nodes = set()
+    for source, target in edges:
+        if source == target: continue
+        outlinks.setdefault(source, set()).add(target)
+        nodes.add(source)
+        nodes.add(target)
+
+    n = len(nodes)
+    if n == 0: return {}
+
+    # the graph is sparse, so push rank along each page's outlinks rather than multiplying by a dense matrix
+    inlinks = {node: [] for node in nodes}
+    for source, targets in outlinks.items():
+        share = 1.0 / len(targets)
+        for target in targets:
+            inlinks[target].append((source, share))
+    dangling = [node for node in nodes if node not in outlinks]
+
+    if previous:
+        ranks = {node: previous.get(node, 1.0 / n) for node in nodes}
+        total = sum(ranks.values())
+        ranks = {node: rank / total for node, rank in ranks.items()}
+    else:
+        ranks = {node: 1.0 / n for node in nodes}
+
+    for iteration in range(max_iterations):
+        # pages with no outlinks spread their rank evenly over everything
+        base = (1.0 - damping) / n + damping * sum(ranks[node] for node in dangling) / n
+        new_ranks = {}
+        for node in nodes:
+            new_ranks[node] = base + damping * sum(ranks[source] * share for source, share in inlinks[node])
+
+        delta = sum(abs(new_ranks[node] - ranks[node]) for node in nodes)
+        ranks = new_ranks
+        if delta < tolerance: break
+
+    return ranks
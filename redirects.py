@@ -0,0 +1,72 @@
+import threading
+
+if "." in __name__:
+    from .util import title_to_filename
+else:
+    from util import title_to_filename
+
+
+# where a page's source says to go, if it's a redirect
+def source_redirect(source):
+    if source and source.startswith(b'=> '):
+        return title_to_filename(source[3:].decode('utf-8').strip())
+    return None
+
+# follows a chain of redirects a step at a time, with step(filename) giving the next page or None; gives the page
+# at the end, or None if the chain goes round in a circle and there's nowhere to send anyone
+def follow_redirects(filename, step):
+    seen = {filename}
+    target = step(filename)
+    while target is not None:
+        if target in seen: return None
+        seen.add(target)
+        next_target = step(target)
+        if next_target is None: return target
+        target = next_target
+    return None
+
+# flattens the links database's redirects table into source -> final target, once per index revision
+class RedirectResolver:
+    def __init__(self, links):
+        self.links = links
+        self.version = None
+        self.direct = {}
+        self.targets = {}
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        version = self.links.indexed_revision
+        if version == self.version: return
+
+        with self.lock:
+            if version == self.version: return
+            c = self.links.conn.cursor()
+            direct = {source: title_to_filename(target) for source, target in c.execute('SELECT source, target FROM redirects')}
+
+            # a cycle has no final page to send anyone to, so its pages map to None
+            targets = {source: follow_redirects(source, direct.get) for source in direct}
+
+            aliases = {}
+            for source, target in targets.items():
+                if target is not None:
+                    aliases.setdefault(target, []).append(source)
+
+            self.direct, self.targets, self.aliases, self.version = direct, targets, aliases, version
+
+    def resolve(self, filename):
+        self.refresh()
+        return self.targets.get(filename)
+
+    # where a page's own redirect points, before following any chain
+    def direct_target(self, filename):
+        self.refresh()
+        return self.direct.get(filename)
+
+    def is_redirect(self, filename):
+        self.refresh()
+        return filename in self.targets
+
+    def aliases_of(self, filename):
+        self.refresh()
+        return self.aliases.get(filename, [])
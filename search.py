@@ -1,31 +1,58 @@
+import copy
+import math
 import os
 import os.path
 import sqlite3
-from urllib.parse import urlparse
+import threading
+import weakref
 
-import lxml.html.html5parser as html5
 import whoosh.fields
 import whoosh.index
 import whoosh.qparser
+import whoosh.query
+import whoosh.scoring
 
 if "." in __name__:
     from .database import Database
-    from .util import url_to_filename, filename_to_title, filename_to_url
+    from .indexer import index_workers
+    from .pagerank import pagerank
+    from .util import filename_to_title, filename_to_url
 else:
     from database import Database
-    from util import url_to_filename, filename_to_title, filename_to_url
+    from indexer import index_workers
+    from pagerank import pagerank
+    from util import filename_to_title, filename_to_url
 
 
-ns = {'h':'http://www.w3.org/1999/xhtml'}
+# And and Or find and score the same documents whatever order their subqueries come in, so they're sorted, for
+# the search cache to see "beta alpha" and "alpha beta" as one search; anything else keeps the order it has
+def canonical_query(query):
+    if type(query) in (whoosh.query.And, whoosh.query.Or):
+        query = copy.copy(query)
+        query.subqueries = sorted((canonical_query(subquery) for subquery in query.subqueries), key=str)
+        return query
+    return query.apply(canonical_query)
 
 class LinksDatabase(Database):
     database_name = 'links.sqlite3'
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.conn = sqlite3.connect(self.path)
+        # the background updater writes from its own thread
+        self.local = threading.local()
+        self.ranks = {}
+        self.ranks_version = None
+    
+    @property
+    def conn(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path)
+        return self.local.conn
 
     def do_create(self):
         c = self.conn.cursor()
+        # anything already here is left over from a build which never finished, and can't be trusted
+        for table in ('links', 'redirects', 'pageranks'):
+            c.execute("DROP TABLE IF EXISTS %s" % table)
         c.execute("CREATE TABLE links (id INTEGER PRIMARY KEY, source TEXT NOT NULL, target TEXT NOT NULL)")
         c.execute("CREATE INDEX outlinks ON links (source)")
         c.execute("CREATE INDEX inlinks ON links (target)")
@@ -36,53 +63,75 @@ class LinksDatabase(Database):
         c.execute("CREATE TABLE pageranks (page TEXT PRIMARY KEY NOT NULL, rank REAL NOT NULL)")
         self.conn.commit()
     
-    def do_update(self, differences):
-        c = self.conn.cursor()
+    def do_begin(self, rebuilding=False, revision=None):
+        self.cursor = self.conn.cursor()
+        # most edits leave a page's links alone, and then the page ranks can't have changed either
+        self.links_changed = False
+    
+    def do_apply(self, change, document):
+        c = self.cursor
         
+        def outlinks(page):
+            return {row[0] for row in c.execute('SELECT target FROM links INDEXED BY outlinks WHERE source = ?', (page,))}
         def delete_page(page):
             c.execute('DELETE FROM links INDEXED BY outlinks WHERE source = ?', (page,))
             c.execute('DELETE FROM redirects WHERE source = ?', (page,))
-        def index_content(page, content):
-            content = content.decode('utf-8')
-            if content.startswith('=> '):
-                c.execute('INSERT INTO redirects (source, target) VALUES (?, ?)', (page, content[3:].strip()))
+        def index_document(page, document):
+            if document.redirect_to is not None:
+                c.execute('INSERT INTO redirects (source, target) VALUES (?, ?)', (page, document.redirect_to))
                 return
             
-            src = html5.fragment_fromstring(self.site.to_html(content), create_parent='div')
-            links = src.xpath('//h:a[@href]', namespaces=ns)
-            page_links = set()
-            
-            for link in links:
-                dest = link.attrib['href']
-                destinfo = urlparse(dest)
-                if dest.startswith('wiki:'):
-                    dest_name = url_to_filename(dest[5:])
-                    page_links.add((page, dest_name))
-                elif dest.rstrip('/') == self.site.base_url.rstrip('/'):
-                    page_links.add((page, 'Homepage'))
-            
-            c.executemany('INSERT INTO links (source, target) VALUES (?, ?)', list(page_links))
-        
-        try:
-            for page, difference in differences.items():
-                op, content = difference
-                if op == 'created':
-                    index_content(page, content)
-                elif op == 'updated':
-                    delete_page(page)
-                    index_content(page, content)
-                elif op == 'deleted':
-                    delete_page(page)
-        except:
-            self.conn.rollback()
-            raise
+            c.executemany('INSERT INTO links (source, target) VALUES (?, ?)', [(page, target) for target in document.links])
+        def new_links(document):
+            return set() if document.redirect_to is not None else document.links
         
+        if change.op == 'created':
+            if new_links(document): self.links_changed = True
+            index_document(change.page, document)
+        elif change.op == 'updated':
+            if outlinks(change.page) != new_links(document): self.links_changed = True
+            delete_page(change.page)
+            index_document(change.page, document)
+        elif change.op == 'deleted':
+            if outlinks(change.page): self.links_changed = True
+            delete_page(change.page)
+        elif change.op == 'moved':
+            # the content is identical, so the outgoing links just change hands
+            c.execute('UPDATE links INDEXED BY outlinks SET source = ? WHERE source = ?', (change.page, change.old_page))
+            if c.rowcount: self.links_changed = True
+            c.execute('UPDATE redirects SET source = ? WHERE source = ?', (change.page, change.old_page))
+    
+    def do_commit(self):
+        if self.links_changed: self.update_pageranks()
         self.conn.commit()
+    
+    def do_abort(self):
+        self.conn.rollback()
+    
+    def update_pageranks(self):
+        c = self.cursor
+        previous = dict(c.execute('SELECT page, rank FROM pageranks').fetchall())
+        ranks = pagerank(c.execute('SELECT source, target FROM links').fetchall(), previous=previous)
+        c.execute('DELETE FROM pageranks')
+        c.executemany('INSERT INTO pageranks (page, rank) VALUES (?, ?)', ranks.items())
+    
+    def pageranks(self):
+        version = self.indexed_revision
+        if self.ranks_version != version:
+            c = self.conn.cursor()
+            self.ranks = dict(c.execute('SELECT page, rank FROM pageranks').fetchall())
+            self.ranks_version = version
+        return self.ranks
 
-    def inlinks(self, filename):
+    def inlinks(self, filename, aliases=()):
         self.update()
+        targets = [filename] + list(aliases)
         c = self.conn.cursor()
-        c.execute('SELECT source FROM links WHERE target = ?', (filename,))
+        # with a background updater, or another process doing the indexing, the first build may not be done yet
+        if self.indexed_revision is None: return
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'links'")
+        if c.fetchone() is None: return
+        c.execute('SELECT DISTINCT source FROM links INDEXED BY inlinks WHERE target IN (%s) ORDER BY source' % ', '.join('?' * len(targets)), targets)
         for result in c:
             yield Link(filename_to_url(result[0]), filename_to_title(result[0]))
 
@@ -91,21 +140,75 @@ class Link:
         self.url = url
         self.title = title
 
+# BM25F, nudged towards pages which are linked to a lot
+class RankedBM25F(whoosh.scoring.BM25F):
+    use_final = True
+    
+    def __init__(self, ranks, weight=1.0, **kwargs):
+        super().__init__(**kwargs)
+        # decoding stored fields for every hit is slow, so each segment's filenames are read once; segment readers
+        # are reused when a searcher is refreshed, so only new segments ever have to be read
+        self.filenames = weakref.WeakKeyDictionary()
+        self.ranks, self.weight = None, None
+        self.rank_by(ranks, weight)
+    
+    def rank_by(self, ranks, weight):
+        if ranks is self.ranks and weight == self.weight: return
+        self.ranks = ranks
+        self.weight = weight
+        self.boosts_reader = None
+    
+    def segment_filenames(self, segment):
+        filenames = self.filenames.get(segment)
+        if filenames is None:
+            filenames = [None] * segment.doc_count_all()
+            for docnum, fields in segment.iter_docs():
+                filenames[docnum] = fields['filename']
+            self.filenames[segment] = filenames
+        return filenames
+    
+    # one multiplier per document number in the reader, worked out whenever the reader or the ranks change
+    def boosts(self, reader):
+        if self.boosts_reader is reader: return self.boosts_by_docnum
+        
+        boosts = []
+        # ranks sum to 1, so scale by the number of pages to make an average page 1
+        scale = len(self.ranks)
+        for segment, offset in reader.leaf_readers():
+            for filename in self.segment_filenames(segment):
+                rank = self.ranks.get(filename)
+                boosts.append(1.0 if rank is None else 1 + self.weight * math.log1p(rank * scale))
+        
+        self.boosts_reader, self.boosts_by_docnum = reader, boosts
+        return boosts
+    
+    def final(self, searcher, docnum, score):
+        return score * self.boosts(searcher.reader())[docnum]
+
 class SearchDatabase(Database):
     database_name = 'search.whoosh'
+    # the title is derived from the filename, so a renamed page has to be reindexed
+    moves_need_document = True
     schema = whoosh.fields.Schema(
         filename=whoosh.fields.ID(stored=True, unique=True),
         url=whoosh.fields.STORED,
         title=whoosh.fields.TEXT(field_boost=2.0, stored=True),
-        content=whoosh.fields.TEXT,
+        # stored, so results can be highlighted without going back to git
+        content=whoosh.fields.TEXT(stored=True),
         redirect_to=whoosh.fields.STORED
     )
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.parser = whoosh.qparser.MultifieldParser(['title', 'content'], SearchDatabase.schema)
+        # whoosh searchers mustn't be shared between threads, so each thread keeps its own
+        self.local = threading.local()
         
         if whoosh.index.exists_in(self.path):
             self.index = whoosh.index.open_dir(self.path)
+            if 'content' not in self.index.schema.stored_names():
+                # built before content was stored; have the indexer start again from scratch
+                if os.path.exists(self.path + '.head'): os.remove(self.path + '.head')
         else:
             if not os.path.isdir(self.path): os.mkdir(self.path)
             self.index = None
@@ -113,47 +216,84 @@ class SearchDatabase(Database):
     def do_create(self):
         self.index = whoosh.index.create_in(self.path, SearchDatabase.schema)
     
-    def do_update(self, differences):
+    def do_begin(self, rebuilding=False, revision=None):
         self.index = self.index.refresh()
-        with self.index.writer() as writer:
-            for page, difference in differences.items():
-                op, content = difference
-                
-                if content:
-                    content = content.decode('utf-8')
-                    if content.startswith('=> '):
-                        redirect_to = content[3:].strip()
-                        doc = {
-                            'filename': page,
-                            'url': filename_to_url(page),
-                            'title': filename_to_title(page),
-                            'content': '',
-                            'redirect_to': redirect_to
-                        }
-                    else:
-                        src = html5.fragment_fromstring(self.site.to_html(content), create_parent='div')
-                        content = ' '.join(src.xpath('//text()'))
-                        doc = {
-                            'filename': page,
-                            'url': filename_to_url(page),
-                            'title': filename_to_title(page),
-                            'content': content,
-                            'redirect_to': None
-                        }
-                
-                if op == 'created':
-                    writer.add_document(**doc)
-                elif op == 'updated':
-                    writer.update_document(**doc)
-                elif op == 'deleted':
-                    writer.delete_by_term('filename', page)
+        if rebuilding:
+            # a full build can spread segment writing over several processes
+            self.writer = self.index.writer(procs=index_workers(self.site), multisegment=True)
+        else:
+            self.writer = self.index.writer()
+    
+    def do_apply(self, change, document):
+        if change.op in {'deleted', 'moved'}:
+            self.writer.delete_by_term('filename', change.old_page or change.page)
+        
+        if document:
+            doc = {
+                'filename': change.page,
+                'url': filename_to_url(change.page),
+                'title': filename_to_title(change.page),
+                'content': document.text,
+                'redirect_to': document.redirect_to
+            }
+            
+            if change.op in {'created', 'moved'}:
+                self.writer.add_document(**doc)
+            elif change.op == 'updated':
+                self.writer.update_document(**doc)
+    
+    def do_commit(self):
+        self.writer.commit()
+    
+    def do_abort(self):
+        self.writer.cancel()
 
-    def search(self, query):
+    # a process which doesn't do the indexing itself may have started before there was an index to open
+    def open_index(self):
+        if self.index is None and whoosh.index.exists_in(self.path):
+            self.index = whoosh.index.open_dir(self.path)
+        return self.index
+    
+    def searcher(self):
+        searcher = getattr(self.local, 'searcher', None)
+        if searcher is None or self.local.index is not self.index:
+            if searcher is not None: searcher.close()
+            searcher = self.index.searcher(weighting=RankedBM25F({}))
+            self.local.index = self.index
+        elif not searcher.up_to_date():
+            # reuses the readers for any segments which haven't changed, so the old searcher is left open
+            searcher = searcher.refresh()
+        self.local.searcher = searcher
+        return searcher
+    
+    def search(self, query, page=1, pagelen=30):
         self.update()
-        self.index = self.index.refresh()
-        parser = whoosh.qparser.MultifieldParser(['title', 'content'], SearchDatabase.schema)
-        parsed_query = parser.parse(query)
-        with self.index.searcher() as searcher:
-            results = searcher.search(parsed_query, limit=30)
-            return list(dict(result) for result in results)
+        if self.open_index() is None:
+            return {'results': [], 'total': 0, 'page': page, 'pagecount': 0}
+        
+        parsed_query = self.parser.parse(query)
+        # parsing takes care of spacing and case, and canonical_query of term order
+        normalized_query = str(canonical_query(parsed_query))
+        generation = '%s:%s' % (self.indexed_revision, self.site.links.indexed_revision)
+        cached = self.site.search_cache.get(generation, normalized_query, page, pagelen)
+        if cached is not None:
+            return cached
+        
+        searcher = self.searcher()
+        searcher.weighting.rank_by(self.site.links.pageranks(), self.site.config.get('pagerank_weight', 1.0))
+        
+        hits = searcher.search_page(parsed_query, page, pagelen=pagelen, terms=True)
+        results = []
+        for hit in hits:
+            result = dict(hit)
+            # an index built before content was stored has none to highlight, until it's been rebuilt
+            content = result.pop('content', None)
+            result['highlights'] = hit.highlights('content', text=content) if content is not None else ''
+            if result.get('redirect_to') is not None:
+                target = self.site.redirects.resolve(result['filename'])
+                result['target_url'] = filename_to_url(target) if target else None
+            results.append(result)
         
+        results = {'results': results, 'total': hits.total, 'page': hits.pagenum, 'pagecount': hits.pagecount}
+        self.site.search_cache.put(generation, normalized_query, page, pagelen, results)
+        return results
@@ -0,0 +1,161 @@
+"""
+server -- a preforking, multithreaded WSGI server for running ikwi in production
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return (host.strip('[]') or '0.0.0.0', int(port))
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        print('[%d] %s - %s' % (os.getpid(), self.address_string(), format % args), file=sys.stderr)
+
+# a WSGI server on an already-listening socket, which hands connections to a fixed pool of threads
+class PooledWSGIServer(WSGIServer):
+    def __init__(self, listener, app, threads, max_queued=None):
+        socketserver.BaseServer.__init__(self, listener.getsockname(), QuietRequestHandler)
+        self.socket = listener
+        self.server_name = socket.getfqdn(listener.getsockname()[0])
+        self.server_port = listener.getsockname()[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        # once every thread is busy and a few connections are queued, stop accepting more, so the rest wait in
+        # the listen backlog where another worker process can pick them up
+        self.slots = threading.BoundedSemaphore(threads + (threads if max_queued is None else max_queued))
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        # let requests which are already running finish
+        self.pool.shutdown(wait=True)
+
+class Server:
+    def __init__(self, make_app, *, bind='127.0.0.1:3000', workers=2, threads=4, graceful_timeout=30):
+        self.make_app = make_app
+        self.address = parse_bind(bind)
+        self.worker_count = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.workers = {} # pid -> slot
+        self.stopping = False
+        self.reloading = False
+
+    def listen(self):
+        family = socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(128)
+        return listener
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = slot
+            return pid
+
+        # in the worker: anything holding file descriptors or threads (the repository, SQLite, Whoosh, the
+        # background indexer) is only opened now, after the fork
+        for signum in (signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            app = self.make_app(slot)
+            server = PooledWSGIServer(self.listener, app, self.threads)
+            def stop(signum, frame):
+                threading.Thread(target=server.shutdown).start()
+            signal.signal(signal.SIGTERM, stop)
+            server.serve_forever()
+            server.server_close()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def kill_workers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self, block=False):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0: return
+            slot = self.workers.pop(pid, None)
+            if slot is not None and not self.stopping:
+                print('worker %d exited; starting another' % pid, file=sys.stderr)
+                self.spawn(slot)
+
+    def reload(self):
+        # start a fresh set of workers, then let the old ones finish what they're doing and leave
+        old_pids = list(self.workers)
+        for pid in old_pids: del self.workers[pid]
+        for slot in range(self.worker_count): self.spawn(slot)
+        self.kill_workers(old_pids, signal.SIGTERM)
+
+    def shutdown(self):
+        self.stopping = True
+        self.kill_workers(list(self.workers), signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill_workers(list(self.workers), signal.SIGKILL)
+        self.reap(block=True)
+
+    def run(self):
+        self.listener = self.listen()
+        print('ikwi listening on %s:%d with %d workers of %d threads' % (self.address + (self.worker_count, self.threads)), file=sys.stderr)
+
+        def on_stop(signum, frame): self.stopping = True
+        def on_reload(signum, frame): self.reloading = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+
+        for slot in range(self.worker_count): self.spawn(slot)
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.reload()
+                self.reap()
+                time.sleep(0.5)
+        finally:
+            self.shutdown()
+            self.listener.close()
@@ -5,10 +5,11 @@ storage -- tidemark git in a way that's useful for building web-apps
 # todo: straighten out the terminology used here ('store' and 'storage'; 'commit_id', 'commit', and 'revision')
 # merge conflict resolution API probably needs a little tweaking
 
-from collections import deque
+from collections import deque, OrderedDict
 from datetime import datetime, timezone, timedelta
 import os
 import os.path
+import threading
 import time
 import warnings
 
@@ -30,13 +31,20 @@ class Storage:
     def __init__(self, repo_path):
         self.repo = pygit2.Repository(repo_path)
     
-    def cursor(self, base_commit):
-        return Cursor(self, commit_id(base_commit))
+    def cursor(self, base_commit, *, staged=False):
+        return Cursor(self, commit_id(base_commit), staged=staged)
     
     def latest(self):
         head_commit = self.repo[self.repo.head.resolve().target]
         return StorageRevision(self, head_commit.id, head_commit.tree)
     
+    def at_revision(self, revision):
+        try:
+            commit = self.repo[commit_id(revision)]
+        except (KeyError, ValueError):
+            raise FileNotFoundError('no such revision %r' % revision)
+        return StorageRevision(self, commit.id, commit.tree)
+    
     def history(self):
         for commit in self.repo.walk(self.repo.head.resolve().target, pygit2.GIT_SORT_TIME):
             date = datetime.fromtimestamp(commit.commit_time, timezone(timedelta(minutes=commit.commit_time_offset)))
@@ -64,58 +72,180 @@ class Storage:
         
         return lock
 
+# oids name immutable objects, so nothing in here ever needs invalidating: it only needs to be kept within budget
+class ObjectCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_blob_size=256 * 1024):
+        self.max_bytes = max_bytes
+        self.max_blob_size = max_blob_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return None
+    
+    def store(self, key, value, size):
+        if size > self.max_bytes: return
+        with self.lock:
+            if key in self.entries: return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+    
+    def tree_entries(self, repo, tree_id):
+        key = ('tree', tree_id)
+        entries = self.lookup(key)
+        if entries is None:
+            entries = {entry.name: (str(entry.id), entry.filemode) for entry in repo[tree_id]}
+            # a rough guess at what the listing costs us
+            self.store(key, entries, sum(len(name) + 100 for name in entries))
+        return entries
+    
+    def blob_data(self, repo, blob_id):
+        key = ('blob', blob_id)
+        data = self.lookup(key)
+        if data is None:
+            data = repo[blob_id].data
+            if len(data) <= self.max_blob_size:
+                self.store(key, data, len(data))
+        return data
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits / total) if total else 0.0,
+            'entries': len(self.entries),
+            'bytes': self.size
+        }
+
+object_cache = ObjectCache()
+
+# resolving HEAD means a commit lookup and a new StorageRevision; stat()ing the files behind it is much cheaper,
+# so only do the former when the latter says something has moved
+class RevisionWatcher:
+    def __init__(self, storage):
+        self.storage = storage
+        self.stamp = None
+        self.ref_name = None
+        self.revision = None
+        self.lock = threading.Lock()
+    
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+    
+    def current_stamp(self):
+        repo_path = self.storage.repo.path
+        head_stamp = self.stat(os.path.join(repo_path, 'HEAD'))
+        if self.stamp is None or head_stamp != self.stamp[0]:
+            # HEAD itself moved, so the branch it points to might have too
+            with open(os.path.join(repo_path, 'HEAD'), 'r', encoding='utf-8') as f:
+                head = f.read().strip()
+            self.ref_name = head[5:].strip() if head.startswith('ref:') else None
+        
+        ref_stamp = self.stat(os.path.join(repo_path, self.ref_name)) if self.ref_name else None
+        return (head_stamp, ref_stamp, self.stat(os.path.join(repo_path, 'packed-refs')))
+    
+    def latest(self):
+        stamp = self.current_stamp()
+        if stamp != self.stamp or self.revision is None:
+            with self.lock:
+                self.revision = self.storage.latest()
+                self.stamp = stamp
+        return self.revision
+
 class StorageRevision:
     def __init__(self, storage, revision, tree, root_tree=None):
         self.storage = storage
         self.revision = commit_id(revision)
-        self.tree = tree
+        # trees can be handed over as objects or as bare ids; the latter are only looked up if someone asks for them
+        if isinstance(tree, pygit2.Tree):
+            self.tree_id = commit_id(tree.id)
+            self._tree = tree
+        else:
+            self.tree_id = commit_id(tree)
+            self._tree = None
         if not root_tree:
             self.root_tree = tree
         else:
             self.root_tree = root_tree
     
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = self.storage.repo[self.tree_id]
+        return self._tree
+    
+    @property
+    def entries(self):
+        return object_cache.tree_entries(self.storage.repo, self.tree_id)
+    
     def __contains__(self, filename):
-        return (filename in self.tree) and (self.tree[filename].filemode == pygit2.GIT_FILEMODE_BLOB)
+        entry = self.entries.get(filename)
+        return (entry is not None) and (entry[1] == pygit2.GIT_FILEMODE_BLOB)
     
     def get_id(self, filename):
-        tree_entry = self.tree[filename]
-        return str(tree_entry.id)
+        return self.entries[filename][0]
     
     def get(self, filename):
-        if filename not in self.tree: return None
-        tree_entry = self.tree[filename]
-        if tree_entry.filemode != pygit2.GIT_FILEMODE_BLOB: return None
-        blob = self.storage.repo[tree_entry.id]
-        return blob.data
+        entry = self.entries.get(filename)
+        if entry is None: return None
+        entry_id, filemode = entry
+        if filemode != pygit2.GIT_FILEMODE_BLOB: return None
+        return object_cache.blob_data(self.storage.repo, entry_id)
     
     def dir(self, dirname):
-        if dirname not in self.tree: return EmptyStorageRevision()
-        tree_entry = self.tree[dirname]
-        if tree_entry.filemode != pygit2.GIT_FILEMODE_TREE: return EmptyStorageRevision()
-        tree = self.storage.repo[tree_entry.id]
-        return StorageRevision(self.storage, self.revision, tree, self.root_tree)
+        entry = self.entries.get(dirname)
+        if entry is None: return EmptyStorageRevision()
+        entry_id, filemode = entry
+        if filemode != pygit2.GIT_FILEMODE_TREE: return EmptyStorageRevision()
+        return StorageRevision(self.storage, self.revision, entry_id, self.root_tree)
     
     def diff_files(self, old_rev, include_contents=False):
         diffs = {}
-        for entry in self.tree:
-            if entry.filemode != pygit2.GIT_FILEMODE_BLOB: continue
-            if entry.name not in old_rev:
-                diffs[entry.name] = ('created', None)
-            elif commit_id(entry.id) != old_rev.get_id(entry.name):
-                diffs[entry.name] = ('updated', None)
-        for entry in old_rev.tree:
-            if entry.name not in self:
-                diffs[entry.name] = ('deleted', None)
+        for name, (entry_id, filemode) in self.entries.items():
+            if filemode != pygit2.GIT_FILEMODE_BLOB: continue
+            if name not in old_rev:
+                diffs[name] = ('created', None)
+            elif entry_id != old_rev.get_id(name):
+                diffs[name] = ('updated', None)
+        for name in old_rev.entries:
+            if name not in self:
+                diffs[name] = ('deleted', None)
         
         return diffs
 
 # this needs a better API
 class EmptyStorageRevision:
+    entries = {}
+    def __contains__(self, filename): return False
+    def get_id(self, filename): raise KeyError(filename)
     def get(self, filename): return None
+    def dir(self, dirname): return self
 
 class InvalidOperationError(Exception): pass
 class Cursor:
-    def __init__(self, storage, base_commit, *, original_base_commit=None):
+    def __init__(self, storage, base_commit, *, original_base_commit=None, staged=False):
         self.storage = storage
         self.repo = self.storage.repo
         self.base_commit_id = commit_id(base_commit)
@@ -126,9 +256,18 @@ class Cursor:
             self.original_base_commit_id = commit_id(base_commit)
         
         self.root_tree = self.repo[base_commit].tree
+        
+        # a staged cursor collects changes (path -> blob id, or None to delete) and only writes trees when saved
+        self.staged = staged
+        self.pending = {}
     
     def add(self, path, contents):
         blob_id = self.repo.create_blob(contents)
+        if self.staged:
+            # replaces any earlier delete of the same path, so a delete and then an add comes out as one update
+            self.pending[path] = blob_id
+            return
+        
         idx = pygit2.Index()
         idx.read_tree(self.root_tree)
         
@@ -146,6 +285,11 @@ class Cursor:
         self.root_tree = self.repo[tree_id]
 
     def delete(self, path):
+        if self.staged:
+            existed = self.exists(path)
+            if existed: self.pending[path] = None
+            return existed
+        
         idx = pygit2.Index()
         idx.read_tree(self.root_tree)
         
@@ -158,7 +302,64 @@ class Cursor:
         self.root_tree = self.repo[tree_id]
         return True
     
+    # only files count: like the index, a staged cursor won't delete a whole tree, which would otherwise turn a
+    # later add under that tree into a removal and an addition instead of an update
+    def exists(self, path):
+        if path in self.pending: return self.pending[path] is not None
+        
+        tree = self.root_tree
+        *dirs, name = path.split('/')
+        for dirname in dirs:
+            if dirname not in tree or tree[dirname].filemode != pygit2.GIT_FILEMODE_TREE: return False
+            tree = self.repo[tree[dirname].id]
+        return name in tree and tree[name].filemode != pygit2.GIT_FILEMODE_TREE
+    
+    def flush(self):
+        if not self.pending: return
+        
+        changes = {}
+        for path, blob_id in self.pending.items():
+            *dirs, name = path.split('/')
+            level = changes
+            for dirname in dirs:
+                level = level.setdefault(dirname, {})
+                if not isinstance(level, dict):
+                    raise InvalidOperationError('refusing to replace another kind of object with a tree')
+            if isinstance(level.get(name), dict):
+                raise InvalidOperationError('refusing to replace another kind of object with a tree')
+            level[name] = blob_id
+        
+        tree_id = self.write_tree(self.root_tree, changes)
+        self.root_tree = self.repo[tree_id] if tree_id else self.repo[self.repo.TreeBuilder().write()]
+        self.pending = {}
+    
+    # rebuilds only the subtrees which contain a change; everything else is carried over by id
+    def write_tree(self, tree, changes):
+        builder = self.repo.TreeBuilder(tree) if tree is not None else self.repo.TreeBuilder()
+        for name, change in changes.items():
+            existing = tree[name] if (tree is not None and name in tree) else None
+            
+            if isinstance(change, dict):
+                if existing is not None and existing.filemode != pygit2.GIT_FILEMODE_TREE:
+                    raise InvalidOperationError('refusing to replace another kind of object with a tree')
+                subtree_id = self.write_tree(self.repo[existing.id] if existing is not None else None, change)
+                if subtree_id is None:
+                    if existing is not None: builder.remove(name)
+                else:
+                    builder.insert(name, subtree_id, pygit2.GIT_FILEMODE_TREE)
+            elif change is None:
+                if existing is not None: builder.remove(name)
+            else:
+                if existing is not None and existing.filemode == pygit2.GIT_FILEMODE_TREE:
+                    raise InvalidOperationError('refusing to replace another kind of object with a tree')
+                builder.insert(name, change, pygit2.GIT_FILEMODE_BLOB)
+        
+        # like the index, don't keep empty trees around
+        if len(builder) == 0: return None
+        return builder.write()
+    
     def save(self, message, author, committer=None):
+        self.flush()
         if committer == None: committer = author
         new_commit_id = self.repo.create_commit(
             None, # reference
@@ -0,0 +1,120 @@
+import os
+import uuid
+
+import bcrypt
+import pytest
+
+import auth
+from auth import CredentialCache, SessionSigner
+
+
+def hashed(password):
+    # the fewest rounds bcrypt allows, to keep the tests quick
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=4)).decode('us-ascii')
+
+@pytest.fixture
+def key_path(request):
+    path = '/tmp/%s.key' % uuid.uuid4()
+    def cleanup():
+        if os.path.exists(path): os.remove(path)
+    request.addfinalizer(cleanup)
+    return path
+
+@pytest.fixture
+def editors():
+    return {'alice': {'password': hashed(b'secret')}, 'Zoë': {'password': hashed('pässword'.encode('utf-8'))}}
+
+# counts the passwords auth has to check with bcrypt
+class CountingBcrypt:
+    def __init__(self):
+        self.calls = []
+    def hashpw(self, password, salt):
+        self.calls.append(password)
+        return bcrypt.hashpw(password, salt)
+
+@pytest.fixture
+def hashes(monkeypatch):
+    counter = CountingBcrypt()
+    monkeypatch.setattr(auth, 'bcrypt', counter)
+    return counter.calls
+
+def test_token_round_trip(key_path, editors):
+    signer = SessionSigner(key_path)
+    assert(signer.verify(signer.issue('alice', editors['alice']), editors) == 'alice')
+    assert(signer.verify(signer.issue('Zoë', editors['Zoë']), editors) == 'Zoë')
+    # another worker process, reading the same key
+    assert(SessionSigner(key_path).verify(signer.issue('alice', editors['alice']), editors) == 'alice')
+
+def test_tampered_token(key_path, editors):
+    signer = SessionSigner(key_path)
+    token = signer.issue('alice', editors['alice'])
+    username, expiry, fingerprint, signature = token.split('.')
+    
+    forged_signature = ('0' if signature[0] != '0' else '1') + signature[1:]
+    assert(signer.verify('.'.join([username, expiry, fingerprint, forged_signature]), editors) is None)
+    assert(signer.verify('.'.join([username, str(int(expiry) + 1000), fingerprint, signature]), editors) is None)
+    assert(signer.verify('.'.join([username, expiry, fingerprint]), editors) is None)
+    assert(signer.verify('', editors) is None)
+    
+    os.remove(key_path)
+    assert(SessionSigner(key_path).verify(token, editors) is None)
+
+def test_expired_token(key_path, editors):
+    signer = SessionSigner(key_path, lifetime=-1)
+    assert(signer.verify(signer.issue('alice', editors['alice']), editors) is None)
+
+def test_token_dies_with_changed_entry(key_path, editors):
+    signer = SessionSigner(key_path)
+    token = signer.issue('alice', editors['alice'])
+    
+    editors['alice'] = {'password': hashed(b'new secret')}
+    assert(signer.verify(token, editors) is None)
+    del editors['alice']
+    assert(signer.verify(token, editors) is None)
+
+def test_non_ascii_token(key_path, editors):
+    signer = SessionSigner(key_path)
+    token = signer.issue('alice', editors['alice'])
+    
+    assert(signer.verify(token[:-1] + 'é', editors) is None)
+    assert(signer.verify('é' + token, editors) is None)
+    assert(signer.verify('ünïcödé.1.2.3', editors) is None)
+
+def test_credential_cache(editors, hashes):
+    cache = CredentialCache()
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(len(hashes) == 1)
+    
+    assert(not cache.check('alice', b'wrong', editors['alice']))
+    assert(not cache.check('alice', b'wrong', editors['alice']))
+    assert(len(hashes) == 3)
+
+def test_credential_cache_expiry(editors, hashes, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, 'monotonic', lambda: now[0])
+    cache = CredentialCache(ttl=60)
+    assert(cache.check('alice', b'secret', editors['alice']))
+    now[0] += 59
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(len(hashes) == 1)
+    
+    # past the TTL, the password is checked with bcrypt again
+    now[0] += 2
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(len(hashes) == 2)
+
+def test_credential_cache_follows_entry(editors, hashes):
+    cache = CredentialCache()
+    assert(cache.check('alice', b'secret', editors['alice']))
+    editors['alice'] = {'password': hashed(b'new secret')}
+    assert(not cache.check('alice', b'secret', editors['alice']))
+    assert(cache.check('alice', b'new secret', editors['alice']))
+    assert(len(hashes) == 3)
+
+def test_credential_cache_is_bounded(editors, hashes):
+    cache = CredentialCache(max_entries=1)
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(cache.check('Zoë', 'pässword'.encode('utf-8'), editors['Zoë']))
+    assert(cache.check('alice', b'secret', editors['alice']))
+    assert(len(hashes) == 3)
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+import pytest
+
+from cache import BlobFileCache
+
+
+class FakeSite:
+    def __init__(self, path):
+        self.storage = type('Storage', (), {})()
+        self.storage.repo = type('Repository', (), {'path': path})()
+
+@pytest.fixture
+def site(request):
+    path = '/tmp/%s' % uuid.uuid4()
+    os.mkdir(path)
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    return FakeSite(path)
+
+def test_blob_file_cache_stores_and_finds_large_blobs(site):
+    cache = BlobFileCache(site, min_size=1024)
+    data = os.urandom(4096)
+    blob_id = hashlib.sha1(data).hexdigest()
+    
+    assert(cache.lookup(blob_id) is None)
+    assert(cache.store(blob_id, b'too small') is None)
+    path = cache.store(blob_id, data)
+    assert(cache.lookup(blob_id) == path)
+    with open(path, 'rb') as f: assert(f.read() == data)
+
+def test_blob_file_cache_stores_from_many_threads(site):
+    cache = BlobFileCache(site, min_size=1024)
+    data = os.urandom(2 * 1024 * 1024)
+    blob_id = hashlib.sha1(data).hexdigest()
+    errors = []
+    sizes = []
+    
+    def store():
+        for i in range(10):
+            try:
+                sizes.append(os.path.getsize(cache.store(blob_id, data)))
+            except Exception as err:
+                errors.append(err)
+    
+    threads = [threading.Thread(target=store) for i in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    
+    assert(errors == [])
+    assert(sizes == [len(data)] * 40)
+    # nothing half-written is left behind
+    assert(os.listdir(cache.path) == [blob_id])
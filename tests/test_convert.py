@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+
+import pytest
+
+import convert
+from convert import Converter, PandocLuaBackend, PandocLuaWorker, ConversionError, ConversionTimeout, BackendUnavailable
+
+
+# speaks the same protocol as the Lua loop, but upper-cases instead of converting: "bad" gets an error back,
+# "hang" never gets an answer, and "die" kills a worker which has already converted something
+stand_in = r'''
+import sys
+conversions = 0
+while True:
+    header = sys.stdin.buffer.readline()
+    if not header: break
+    source, to, length = header.split()
+    text = sys.stdin.buffer.read(int(length)).decode('utf-8')
+    if text == 'hang': sys.stdin.buffer.read()
+    if text == 'die' and conversions: sys.exit(1)
+    ok = text != 'bad'
+    result = (text.upper() if ok else 'cannot convert').encode('utf-8')
+    sys.stdout.buffer.write(b'%s %d\n' % (b'ok' if ok else b'error', len(result)) + result)
+    sys.stdout.buffer.flush()
+    conversions += 1
+'''
+
+class StandInWorker(PandocLuaWorker):
+    script = stand_in
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, '-c', self.script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.conversions = 0
+
+# what a pandoc from before `pandoc lua` looks like: it exits without answering
+class OldPandocWorker(StandInWorker):
+    script = 'import sys; sys.exit(1)'
+
+class LowerCaseProcesses:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, source, to, format):
+        self.submitted += 1
+        return self.executor.submit(str.lower, source)
+
+def has_pandoc_lua():
+    try:
+        return subprocess.run([convert.pandoc_path(), 'lua', '-e', ''], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+needs_pandoc_lua = pytest.mark.skipif(not has_pandoc_lua(), reason='needs a pandoc with `pandoc lua`')
+
+@pytest.fixture
+def stand_in_workers(monkeypatch):
+    monkeypatch.setattr(convert, 'PandocLuaWorker', StandInWorker)
+
+def test_framing():
+    worker = StandInWorker()
+    try:
+        assert(worker.convert('été', 'html', 'markdown', 10) == 'ÉTÉ\n')
+        assert(worker.convert('', 'html', 'markdown', 10) == '')
+        assert(worker.convert('one\ntwo\n', 'html', 'markdown', 10) == 'ONE\nTWO\n')
+        assert(worker.conversions == 3)
+    finally:
+        worker.kill()
+
+def test_error_keeps_the_worker(stand_in_workers):
+    lua = PandocLuaBackend(1, 10)
+    with pytest.raises(ConversionError):
+        lua.convert_many(['bad'], 'html', 'markdown')
+    assert(lua.convert_many(['fine'], 'html', 'markdown') == ['FINE\n'])
+    assert(lua.started == 1)
+    assert(lua.available)
+
+def test_timeout_kills_the_worker(stand_in_workers):
+    lua = PandocLuaBackend(1, 0.5)
+    with pytest.raises(ConversionTimeout):
+        lua.convert_many(['hang'], 'html', 'markdown')
+    assert(lua.started == 0)
+    assert(lua.available)
+    assert(lua.convert_many(['after'], 'html', 'markdown') == ['AFTER\n'])
+
+def test_dead_worker_is_replaced(stand_in_workers):
+    lua = PandocLuaBackend(1, 10)
+    assert(lua.convert_many(['one', 'die', 'two'], 'html', 'markdown') == ['ONE\n', 'DIE\n', 'TWO\n'])
+    assert(lua.started == 1)
+    assert(lua.available)
+
+def test_old_pandoc_falls_back_to_processes(monkeypatch):
+    monkeypatch.setattr(convert, 'PandocLuaWorker', OldPandocWorker)
+    converter = Converter(workers=1, timeout=10)
+    converter.processes = LowerCaseProcesses()
+    assert(converter.convert_many(['One', 'Two'], 'html', 'markdown') == ['one', 'two'])
+    assert(not converter.lua.available)
+    assert(converter.lua.started == 0)
+    # and it doesn't try again
+    assert(converter.convert('Three', 'html', 'markdown') == 'three')
+    assert(converter.processes.submitted == 3)
+
+@needs_pandoc_lua
+def test_pandoc_lua_framing():
+    worker = PandocLuaWorker()
+    try:
+        assert(worker.convert('*été*', 'html', 'markdown', 30) == '<p><em>été</em></p>\n')
+        assert(worker.convert('', 'html', 'markdown', 30) == '')
+        assert(worker.convert('one\n\ntwo', 'html', 'markdown', 30) == '<p>one</p>\n<p>two</p>\n')
+        with pytest.raises(ConversionError):
+            worker.convert('text', 'html', 'no-such-format', 30)
+        assert(worker.alive)
+    finally:
+        worker.kill()
+
+@needs_pandoc_lua
+def test_pandoc_lua_batches():
+    converter = Converter(workers=2, timeout=30)
+    sources = ['page %d' % n for n in range(10)]
+    assert(converter.convert_many(sources, 'html', 'markdown') == ['<p>page %d</p>\n' % n for n in range(10)])
+    assert(converter.lua.available)
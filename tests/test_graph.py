@@ -0,0 +1,52 @@
+import pytest
+
+from graph import LinkSnapshot
+
+
+@pytest.fixture
+def snapshot():
+    pages = {'Homepage', 'Alpha', 'Beta', 'Gamma', 'Delta', 'Lonely', 'Old_Alpha', 'Moved_Away', 'Loop_A', 'Loop_B'}
+    edges = [
+        ('Homepage', 'Alpha'),
+        ('Alpha', 'Beta'),
+        ('Alpha', 'Alpha'),
+        ('Beta', 'Gamma'),
+        ('Gamma', 'Delta'),
+        ('Delta', 'Old_Alpha'),
+        ('Beta', 'Nowhere'),
+        ('Gamma', 'Nowhere'),
+        ('Gamma', 'Moved_Away'),
+        ('Delta', 'Gone'),
+        ('Alpha', 'Loop_A'),
+    ]
+    # already followed to the end of any chain; a cycle leads nowhere
+    redirects = {'Old_Alpha': 'Alpha', 'Moved_Away': 'Gone', 'Loop_A': None, 'Loop_B': None}
+    return LinkSnapshot(pages, edges, redirects)
+
+def test_links_follow_redirects(snapshot):
+    assert(snapshot.outlinks['Delta'] == {'Alpha', 'Gone'})
+    assert(snapshot.inlinks['Alpha'] == {'Homepage', 'Delta'})
+    # links to themselves and into a redirect cycle go nowhere
+    assert(snapshot.outlinks['Alpha'] == {'Beta'})
+
+def test_orphans(snapshot):
+    # neither the homepage nor a redirect is an orphan for having no links to it
+    assert(snapshot.orphans() == ['Lonely'])
+
+def test_wanted(snapshot):
+    # Gamma links to Gone through a redirect and Delta links straight there, so it's wanted twice
+    assert(snapshot.wanted() == [('Gone', 2), ('Nowhere', 2)])
+
+def test_neighbourhood_hops(snapshot):
+    assert(snapshot.neighbourhood('Beta', 1) == {'Alpha': 1, 'Gamma': 1, 'Nowhere': 1})
+    assert(snapshot.neighbourhood('Beta', 2) == {'Alpha': 1, 'Gamma': 1, 'Nowhere': 1, 'Homepage': 2, 'Delta': 2, 'Gone': 2})
+    assert(snapshot.neighbourhood('Beta', 0) == {})
+
+def test_neighbourhood_direction(snapshot):
+    assert(snapshot.neighbourhood('Beta', 2, direction='out') == {'Gamma': 1, 'Nowhere': 1, 'Delta': 2, 'Gone': 2})
+    # Delta's link to Old_Alpha reaches Alpha, so it counts as a link in
+    assert(snapshot.neighbourhood('Alpha', 1, direction='in') == {'Homepage': 1, 'Delta': 1})
+    assert(snapshot.neighbourhood('Alpha', 3, direction='in') == {'Homepage': 1, 'Delta': 1, 'Gamma': 2, 'Beta': 3})
+
+def test_neighbourhood_of_unknown_page(snapshot):
+    assert(snapshot.neighbourhood('Unheard_Of', 2) == {})
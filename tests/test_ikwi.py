@@ -0,0 +1,100 @@
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from ikwi import Ikwi
+from www import Request
+
+
+class FakeDir:
+    def __init__(self, files):
+        self.files = files
+
+    def get_id(self, filename):
+        return 'blob-' + filename
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def dir(self, dirname):
+        return self
+
+class NoBlobFiles:
+    def lookup(self, blob_id): return None
+    def store(self, blob_id, data): return None
+
+class NoRedirects:
+    # an index that hasn't seen any redirects yet
+    def direct_target(self, filename): return None
+    def resolve(self, filename): return None
+
+class FakeSite:
+    blob_files = NoBlobFiles()
+    redirects = NoRedirects()
+
+    def __init__(self, pages=None):
+        self.latest = FakeDir(pages or {})
+
+@pytest.fixture
+def dir():
+    return FakeDir({'image.png': bytes(range(100))})
+
+def serve(dir, headers):
+    request = Request(EnvironBuilder(path='/images/image.png', headers=headers).get_environ())
+    response = Ikwi.serve_blob(FakeSite(), dir, 'image.png', request)
+    return response, b''.join(response.response)
+
+def test_whole_blob(dir):
+    response, body = serve(dir, {})
+    assert(response.status_code == 200)
+    assert(body == bytes(range(100)))
+    assert(response.headers['Accept-Ranges'] == 'bytes')
+
+def test_single_range(dir):
+    response, body = serve(dir, {'Range': 'bytes=0-9'})
+    assert(response.status_code == 206)
+    assert(response.headers['Content-Range'] == 'bytes 0-9/100')
+    assert(response.headers['Content-Length'] == '10')
+    assert(body == bytes(range(10)))
+
+def test_suffix_range(dir):
+    response, body = serve(dir, {'Range': 'bytes=-5'})
+    assert(response.status_code == 206)
+    assert(response.headers['Content-Range'] == 'bytes 95-99/100')
+    assert(body == bytes(range(95, 100)))
+
+def test_range_with_matching_if_range(dir):
+    response, body = serve(dir, {'Range': 'bytes=10-19', 'If-Range': '"blob-image.png"'})
+    assert(response.status_code == 206)
+    assert(body == bytes(range(10, 20)))
+
+def test_range_with_stale_if_range(dir):
+    response, body = serve(dir, {'Range': 'bytes=10-19', 'If-Range': '"some-older-blob"'})
+    assert(response.status_code == 200)
+    assert(body == bytes(range(100)))
+
+def test_multiple_ranges_get_everything(dir):
+    response, body = serve(dir, {'Range': 'bytes=0-9,20-29'})
+    assert(response.status_code == 200)
+    assert(body == bytes(range(100)))
+
+def test_unsatisfiable_range_gets_everything(dir):
+    response, body = serve(dir, {'Range': 'bytes=200-300'})
+    assert(response.status_code == 200)
+    assert(body == bytes(range(100)))
+
+def test_redirect_chain_is_collapsed():
+    site = FakeSite({'A': b'=> B', 'B': b'=> Page C', 'Page_C': b'Here at last'})
+    assert(Ikwi.redirect_target(site, 'A') == 'Page_C')
+    assert(Ikwi.redirect_target(site, 'B') == 'Page_C')
+    assert(Ikwi.redirect_target(site, 'Page_C') is None)
+
+def test_redirect_to_missing_page():
+    site = FakeSite({'A': b'=> Nowhere'})
+    assert(Ikwi.redirect_target(site, 'A') == 'Nowhere')
+
+def test_redirect_cycle_serves_the_page():
+    site = FakeSite({'A': b'=> B', 'B': b'=> C', 'C': b'=> A'})
+    assert(Ikwi.redirect_target(site, 'A') is None)
+    assert(Ikwi.redirect_target(site, 'C') is None)
+    site = FakeSite({'A': b'=> A'})
+    assert(Ikwi.redirect_target(site, 'A') is None)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import uuid
+
+import pygit2
+import pytest
+
+from importer import Importer
+from storage import Storage, Signature
+
+
+class FakeIndexer:
+    def update(self, revision, parallel=False): pass
+
+class FakeSite:
+    def __init__(self, path):
+        self.storage = Storage(path)
+        self.config = {'page_format': 'html'}
+        self.indexer = FakeIndexer()
+    def refresh(self): pass
+
+@pytest.fixture
+def site(request):
+    path = '/tmp/%s.git' % uuid.uuid4()
+    repo = pygit2.init_repository(path, bare=True)
+    signature = Signature('Test User', 'tester@example.org')
+    repo.create_commit('HEAD', signature, signature, 'initial commit', repo.TreeBuilder().write(), [])
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    return FakeSite(path)
+
+@pytest.fixture
+def source(request):
+    path = '/tmp/%s' % uuid.uuid4()
+    os.makedirs(path + '/sub')
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    def write(name, contents):
+        with open(os.path.join(path, name), 'wb') as f: f.write(contents)
+    write('Alpha.html', b'<p>the first alpha</p>')
+    write('sub/Alpha.html', b'<p>the second alpha</p>')
+    write('Beta_Page.html', b'<p>beta</p>')
+    write('picture.png', b'\x89PNG\r\n\x1a\n\x00\x00')
+    write('Latin1.html', b'caf\xe9')
+    return path
+
+def pages(site, revision):
+    repo = site.storage.repo
+    tree = repo[repo[revision].tree['pages'].id]
+    return {entry.name: repo[entry.id].data for entry in tree}
+
+def test_import_skips_duplicates_and_non_pages(site, source):
+    revision, count = Importer(site, progress=False).run(source)
+    
+    assert(count == 2)
+    assert(pages(site, revision) == {'Alpha': b'<p>the first alpha</p>', 'Beta_Page': b'<p>beta</p>'})
+
+def test_import_in_chunks(site, source):
+    revision, count = Importer(site, chunk_size=1, progress=False).run(source)
+    
+    assert(count == 2)
+    assert(set(pages(site, revision)) == {'Alpha', 'Beta_Page'})
+    # one commit per page, on top of the initial one
+    assert(len(list(site.storage.repo.walk(revision))) == 3)
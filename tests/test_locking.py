@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+
+import pygit2
+import pytest
+
+from changes import ChangesDatabase
+from convert import Converter
+from database import Database
+from indexer import Indexer
+from locking import *
+from search import LinksDatabase
+from storage import Storage, Signature
+
+
+def random_lock_path():
+    return '/tmp/%s.lock' % uuid.uuid4()
+
+@pytest.fixture
+def lock_path(request):
+    path = random_lock_path()
+    def cleanup():
+        for suffix in ('', '.head', '.log'):
+            if os.path.exists(path + suffix): os.remove(path + suffix)
+    request.addfinalizer(cleanup)
+    return path
+
+def crash_holding_lock(path):
+    FileLock(path).acquire()
+    os._exit(1)
+
+def test_acquire_and_release(lock_path):
+    lock = FileLock(lock_path)
+    lock.acquire()
+    assert(lock.locked)
+    assert(lock.holder() == os.getpid())
+    lock.release()
+    assert(not lock.locked)
+
+def test_lock_excludes_other_holders(lock_path):
+    with FileLock(lock_path):
+        with pytest.raises(LockTimeout):
+            FileLock(lock_path).acquire(blocking=False)
+        with pytest.raises(LockTimeout):
+            FileLock(lock_path).acquire(timeout=0.1)
+    
+    assert(FileLock(lock_path).acquire(blocking=False))
+
+def test_lock_released_when_holder_dies(lock_path):
+    process = multiprocessing.Process(target=crash_holding_lock, args=(lock_path,))
+    process.start()
+    process.join()
+    
+    lock = FileLock(lock_path)
+    assert(lock.holder() is None)
+    assert(lock.acquire(timeout=1))
+    lock.release()
+
+# a site with real indexes over a real repository, opened afresh in each process
+class IndexedSite:
+    def __init__(self, path, *consumers):
+        self.storage = Storage(path)
+        self.config = {'page_format': 'html', 'index_workers': 1}
+        self.base_url = 'http://wiki.example/'
+        self.converter = Converter(workers=1)
+        self.indexer = Indexer(self)
+        self.links = self.indexer.register(LinksDatabase(self))
+        self.changes = self.indexer.register(ChangesDatabase(self))
+        for consumer in consumers: self.indexer.register(consumer(self))
+
+# notes which processes actually built the indexes
+class BuildLog(Database):
+    database_name = 'builds.log'
+    needs_documents = False
+    def do_create(self): pass
+    def do_begin(self, rebuilding=False, revision=None):
+        with open(self.path, 'a') as f:
+            print(os.getpid(), file=f)
+    def do_apply(self, change, document): pass
+    def do_commit(self): pass
+    def do_abort(self): pass
+
+# gets partway into a build and then hangs, waiting to be killed
+class Stall(BuildLog):
+    database_name = 'stall.log'
+    started = None
+    def do_apply(self, change, document):
+        self.started.set()
+        time.sleep(60)
+
+@pytest.fixture
+def repo(request):
+    path = '/tmp/%s.git' % uuid.uuid4()
+    repo = pygit2.init_repository(path, bare=True)
+    pages = repo.TreeBuilder()
+    for name, source in (('Alpha', b'<p>see <a href="wiki:Beta">Beta</a></p>'), ('Beta', b'<p>nothing</p>'), ('Gamma', b'=> Alpha')):
+        pages.insert(name, repo.create_blob(source), pygit2.GIT_FILEMODE_BLOB)
+    root = repo.TreeBuilder()
+    root.insert('pages', pages.write(), pygit2.GIT_FILEMODE_TREE)
+    signature = Signature('Test User', 'tester@example.org')
+    repo.create_commit('HEAD', signature, signature, 'some pages', root.write(), [])
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    return path
+
+def head(path):
+    return str(pygit2.Repository(path).head.target)
+
+def update(path, start):
+    start.wait()
+    IndexedSite(path, BuildLog).indexer.update(head(path))
+
+def stalled_update(path, started):
+    Stall.started = started
+    IndexedSite(path, Stall).indexer.update(head(path))
+
+def assert_indexed(site, revision):
+    assert(site.links.current_version == revision)
+    assert(site.changes.current_version == revision)
+    c = site.links.conn.cursor()
+    assert(set(c.execute('SELECT source, target FROM links')) == {('Alpha', 'Beta')})
+    assert(set(c.execute('SELECT source, target FROM redirects')) == {('Gamma', 'Alpha')})
+    assert(set(page for page, in c.execute('SELECT page FROM pageranks')) == {'Alpha', 'Beta'})
+
+def test_many_concurrent_updaters(repo):
+    start = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=update, args=(repo, start)) for _ in range(8)]
+    for process in processes: process.start()
+    start.set()
+    for process in processes: process.join()
+    
+    assert(all(process.exitcode == 0 for process in processes))
+    with open(os.path.join(repo, BuildLog.database_name), 'r') as f:
+        assert(len(f.read().split()) == 1)
+    assert_indexed(IndexedSite(repo), head(repo))
+
+def test_rebuild_after_killed_build(repo):
+    started = multiprocessing.Event()
+    process = multiprocessing.Process(target=stalled_update, args=(repo, started))
+    process.start()
+    assert(started.wait(timeout=30))
+    process.kill()
+    process.join()
+    
+    # the killed build left its tables behind, but never said what revision they were for
+    site = IndexedSite(repo)
+    assert(site.links.indexed_revision is None)
+    assert(FileLock(site.indexer.lock_path).holder() is None)
+    
+    site.indexer.update(head(repo))
+    assert_indexed(site, head(repo))
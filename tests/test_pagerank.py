@@ -0,0 +1,45 @@
+import pytest
+
+from pagerank import pagerank
+
+
+edges = [('A', 'B'), ('A', 'C'), ('B', 'C'), ('C', 'A'), ('D', 'C'), ('C', 'E')]
+
+def assert_close(ranks, expected, tolerance=1e-5):
+    assert(set(ranks) == set(expected))
+    for node in ranks:
+        assert(ranks[node] == pytest.approx(expected[node], abs=tolerance))
+
+def test_empty():
+    assert(pagerank([]) == {})
+    assert(pagerank([('A', 'A')]) == {})
+
+def test_ranks_sum_to_one():
+    assert(sum(pagerank(edges).values()) == pytest.approx(1.0))
+
+def test_symmetric_graph():
+    ranks = pagerank([('A', 'B'), ('B', 'C'), ('C', 'A')])
+    assert_close(ranks, {'A': 1/3, 'B': 1/3, 'C': 1/3})
+
+def test_dangling_nodes():
+    # B has no outlinks, so its rank is spread over every page rather than lost
+    ranks = pagerank([('A', 'B')])
+    assert(sum(ranks.values()) == pytest.approx(1.0))
+    # A only gets B's spread rank; B gets that and A's link
+    a = 0.15 / 2 + 0.85 * ranks['B'] / 2
+    assert_close(ranks, {'A': a, 'B': 1 - a})
+    assert(ranks['B'] > ranks['A'])
+
+def test_most_linked_page_ranks_highest():
+    ranks = pagerank(edges)
+    assert(max(ranks, key=ranks.get) == 'C')
+    # D has no inlinks at all, so it gets only the minimum
+    assert(min(ranks, key=ranks.get) == 'D')
+
+def test_warm_start_matches_cold_start():
+    previous = pagerank(edges)
+    edited = edges + [('E', 'D'), ('F', 'A')]
+    cold = pagerank(edited)
+    assert_close(pagerank(edited, previous=previous), cold)
+    # a previous run can also mention pages which have since gone
+    assert_close(pagerank(edges, previous=cold), pagerank(edges))
@@ -0,0 +1,59 @@
+import pytest
+import whoosh.filedb.filestore
+import whoosh.qparser
+
+from search import SearchDatabase, RankedBM25F, canonical_query
+
+
+parser = whoosh.qparser.MultifieldParser(['title', 'content'], SearchDatabase.schema)
+
+def canonical(query):
+    return str(canonical_query(parser.parse(query)))
+
+def test_canonical_query_ignores_term_order():
+    assert(canonical('beta alpha') == canonical('alpha  Beta'))
+    assert(canonical('beta OR alpha') == canonical('alpha OR beta'))
+    assert(canonical('gamma (beta OR alpha)') == canonical('(alpha OR beta) gamma'))
+    assert(canonical('alpha NOT beta') == canonical('NOT beta alpha'))
+
+def test_canonical_query_keeps_what_order_matters_to():
+    assert(canonical('"beta alpha"') != canonical('"alpha beta"'))
+    assert(canonical('alpha beta') != canonical('alpha NOT beta'))
+
+@pytest.fixture
+def index():
+    index = whoosh.filedb.filestore.RamStorage().create_index(SearchDatabase.schema)
+    writer = index.writer()
+    for filename in ('Alpha', 'Beta', 'Gamma'):
+        writer.add_document(filename=filename, title=filename, content='all about wiki gardening')
+    writer.commit()
+    return index
+
+def ranked(searcher, query):
+    return [hit['filename'] for hit in searcher.search(parser.parse(query), limit=None)]
+
+def test_ranks_order_equally_good_matches(index):
+    weighting = RankedBM25F({'Alpha': 0.1, 'Beta': 0.6, 'Gamma': 0.3})
+    with index.searcher(weighting=weighting) as searcher:
+        assert(ranked(searcher, 'gardening') == ['Beta', 'Gamma', 'Alpha'])
+        
+        weighting.rank_by({'Alpha': 0.6, 'Beta': 0.1, 'Gamma': 0.3}, 1.0)
+        assert(ranked(searcher, 'gardening') == ['Alpha', 'Gamma', 'Beta'])
+
+def test_ranks_dont_outweigh_a_better_match(index):
+    weighting = RankedBM25F({'Alpha': 0.1, 'Beta': 0.6, 'Gamma': 0.3})
+    with index.searcher(weighting=weighting) as searcher:
+        # only Alpha has it in the title
+        assert(ranked(searcher, 'alpha OR gardening')[0] == 'Alpha')
+
+def test_ranks_apply_to_new_segments(index):
+    weighting = RankedBM25F({'Alpha': 0.1, 'Beta': 0.2, 'Gamma': 0.3, 'Delta': 0.4})
+    searcher = index.searcher(weighting=weighting)
+    assert(ranked(searcher, 'gardening') == ['Gamma', 'Beta', 'Alpha'])
+    
+    writer = index.writer()
+    writer.add_document(filename='Delta', title='Delta', content='all about wiki gardening')
+    writer.commit(merge=False)
+    searcher = searcher.refresh()
+    assert(ranked(searcher, 'gardening') == ['Delta', 'Gamma', 'Beta', 'Alpha'])
+    searcher.close()
@@ -252,3 +252,100 @@ def test_recreate_merge_conflict(repo):
     recreated_conflict = store.merge_conflict(conflict.source_revision, conflict.target_revision)
     
     assert(conflict.conflicts == recreated_conflict.conflicts)
+
+def test_revision_reads_through_object_cache(repo):
+    store = Storage(repo.path)
+    object_cache.clear()
+    
+    latest = store.latest()
+    assert(latest.get('test1.txt') == b"the first test file\n")
+    misses = object_cache.misses
+    
+    latest = store.latest()
+    assert('test1.txt' in latest)
+    assert(latest.get('test1.txt') == b"the first test file\n")
+    assert(latest.dir('test_tree').get('tree_test.txt') == b"a test file inside a tree\n")
+    assert(object_cache.hits > 0)
+    assert(object_cache.misses == misses + 2) # only the subtree and its blob are new
+
+def test_object_cache_stays_within_budget(repo):
+    cache = ObjectCache(max_bytes=30, max_blob_size=25)
+    blob_ids = [str(repo.create_blob(b'x' * 20 + bytes([i]))) for i in range(3)]
+    for blob_id in blob_ids:
+        cache.blob_data(repo, blob_id)
+    
+    assert(cache.size <= 30)
+    assert(cache.stats()['entries'] == 1)
+    
+    big_blob_id = str(repo.create_blob(b'y' * 100))
+    assert(cache.blob_data(repo, big_blob_id) == b'y' * 100)
+    assert(('blob', big_blob_id) not in cache.entries)
+
+def test_revision_at_unknown_revision(repo):
+    store = Storage(repo.path)
+    with pytest.raises(FileNotFoundError):
+        store.at_revision('0' * 40)
+
+def test_staged_cursor_writes_changes_on_save(repo):
+    store = Storage(repo.path)
+    cursor = store.cursor(repo.head.target, staged=True)
+    original_tree_id = cursor.root_tree.id
+    
+    cursor.add('test3.txt', b"a staged file\n")
+    cursor.add('test_tree/tree_test2.txt', b"a staged file in an existing tree\n")
+    cursor.add('new_tree/deeper/test.txt', b"a staged file in new trees\n")
+    assert(cursor.delete('test1.txt') == True)
+    assert(cursor.delete('nonexistent.txt') == False)
+    assert(cursor.root_tree.id == original_tree_id) # nothing is written until the save
+    
+    cursor.save('staged changes', author=Signature('Test User', 'tester@example.org'))
+    tree = repo[cursor.base_commit_id].tree
+    
+    assert('test1.txt' not in tree)
+    assert(repo[tree['test3.txt'].id].data == b"a staged file\n")
+    subtree = repo[tree['test_tree'].id]
+    assert(repo[subtree['tree_test.txt'].id].data == b"a test file inside a tree\n")
+    assert(repo[subtree['tree_test2.txt'].id].data == b"a staged file in an existing tree\n")
+    deeper = repo[repo[tree['new_tree'].id]['deeper'].id]
+    assert(repo[deeper['test.txt'].id].data == b"a staged file in new trees\n")
+
+def test_staged_cursor_matches_unstaged_cursor(repo):
+    store = Storage(repo.path)
+    staged = store.cursor(repo.head.target, staged=True)
+    unstaged = store.cursor(repo.head.target)
+    
+    for cursor in (staged, unstaged):
+        cursor.add('test_tree/tree_test2.txt', b"another file\n")
+        cursor.delete('test_tree/tree_test.txt')
+        cursor.delete('test2.txt')
+    staged.flush()
+    
+    assert(staged.root_tree.id == unstaged.root_tree.id)
+
+def test_staged_cursor_delete_then_add_is_an_update(repo):
+    store = Storage(repo.path)
+    staged = store.cursor(repo.head.target, staged=True)
+    unstaged = store.cursor(repo.head.target)
+    
+    for cursor in (staged, unstaged):
+        assert(cursor.delete('test2.txt') == True)
+        cursor.add('test2.txt', b"a replacement for the second test file\n")
+        assert(cursor.delete('test_tree') == False)
+        cursor.add('test_tree/tree_test.txt', b"a replacement inside a tree\n")
+    staged.flush()
+    
+    assert(staged.root_tree.id == unstaged.root_tree.id)
+    old = store.latest()
+    new = StorageRevision(store, repo.head.target, staged.root_tree)
+    assert(new.diff_files(old)['test2.txt'] == ('updated', None))
+    assert(new.dir('test_tree').diff_files(old.dir('test_tree')) == {'tree_test.txt': ('updated', None)})
+
+def test_staged_cursor_dont_replace_blobs_with_trees(repo):
+    store = Storage(repo.path)
+    cursor = store.cursor(repo.head.target, staged=True)
+    cursor.add('test2.txt/testfail.txt', b"a test file that shouldn't work\n")
+    
+    with pytest.raises(InvalidOperationError) as excinfo:
+        cursor.save('this should fail', author=Signature('Test User', 'tester@example.org'))
+    
+    assert('refusing to replace another kind of object with a tree' in str(excinfo.value))
@@ -0,0 +1,94 @@
+import pytest
+
+from indexer import Change
+from titles import TitleIndex
+from util import title_to_filename
+
+
+class FakeIndexer:
+    # as if the background updater were keeping the index up to date
+    background = True
+
+class FakeRevision:
+    revision = 'abc123'
+
+class FakeSite:
+    indexer = FakeIndexer()
+    latest = FakeRevision()
+
+def commit(index, changes, rebuilding=False):
+    index.do_begin(rebuilding=rebuilding, revision='abc123')
+    for change in changes:
+        index.do_apply(change, None)
+    index.do_commit()
+    index.set_version('abc123')
+
+def created(*titles):
+    return [Change(title_to_filename(title), 'created') for title in titles]
+
+def titles(results):
+    return [result['title'] for result in results]
+
+@pytest.fixture
+def index():
+    index = TitleIndex(FakeSite())
+    commit(index, created('John Smith', 'Smithy', 'Johnny', 'Café', 'Straße', 'Gardening', 'Garden Tools'), rebuilding=True)
+    return index
+
+def test_prefix(index):
+    assert(titles(index.complete('john')) == ['Johnny', 'John Smith'])
+    assert(titles(index.complete('garden')) == ['Gardening', 'Garden Tools'])
+    assert(titles(index.complete('gardeni')) == ['Gardening'])
+    assert(index.complete('') == [])
+    assert(index.complete('   ') == [])
+
+def test_limit(index):
+    assert(titles(index.complete('garden', limit=1)) == ['Gardening'])
+
+def test_word_in_title(index):
+    # whole-title matches first
+    assert(titles(index.complete('smith')) == ['Smithy', 'John Smith'])
+    assert(titles(index.complete('tools')) == ['Garden Tools'])
+
+def test_fuzzy(index):
+    assert(titles(index.complete('gardneing')) == ['Gardening'])
+    assert(index.complete('zebra') == [])
+
+def test_normalisation(index):
+    assert(titles(index.complete('CAFÉ')) == ['Café'])
+    # decomposed, as some keyboards type it
+    assert(titles(index.complete('Cafe\u0301')) == ['Café'])
+    assert(titles(index.complete('strasse')) == ['Straße'])
+    assert(titles(index.complete('John_Sm')) == ['John Smith'])
+    assert(index.complete('Café')[0]['url'] == 'Café')
+
+def test_incremental_changes(index):
+    commit(index, [
+        Change(title_to_filename('Smithy'), 'deleted'),
+        Change(title_to_filename('Garden Shed'), 'moved', old_page=title_to_filename('Garden Tools')),
+    ] + created('Smithson'))
+    
+    assert(titles(index.complete('smith')) == ['Smithson', 'John Smith'])
+    assert(titles(index.complete('garden')) == ['Gardening', 'Garden Shed'])
+    assert(index.complete('tools') == [])
+    assert(titles(index.complete('shed')) == ['Garden Shed'])
+
+def test_moved_back_and_forth(index):
+    commit(index, [Change(title_to_filename('Jon'), 'moved', old_page=title_to_filename('Johnny'))])
+    commit(index, [Change(title_to_filename('Johnny'), 'moved', old_page=title_to_filename('Jon'))])
+    assert(titles(index.complete('jo')) == ['Johnny', 'John Smith'])
+
+def test_rebuild_replaces_everything(index):
+    readers_entries = index.entries
+    commit(index, created('Only Page'), rebuilding=True)
+    
+    assert(titles(index.complete('only')) == ['Only Page'])
+    assert(index.complete('john') == [])
+    # anyone still holding the old entries keeps a consistent view
+    assert(len(readers_entries[1]) == 7)
+
+def test_abort_changes_nothing(index):
+    index.do_begin(rebuilding=False, revision='def456')
+    index.do_apply(Change(title_to_filename('Johnny'), 'deleted'), None)
+    index.do_abort()
+    assert(titles(index.complete('johnny')) == ['Johnny'])
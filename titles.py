@@ -0,0 +1,135 @@
+"""
+titles -- an in-memory sorted index of page titles, for completing links as they're typed
+"""
+from bisect import bisect_left
+import difflib
+import unicodedata as unicode
+
+if "." in __name__:
+    from .util import filename_to_title, filename_to_url
+else:
+    from util import filename_to_title, filename_to_url
+
+
+# the same normalisation title_to_filename does, plus case folding, so lookups match however the title is typed
+def title_key(title):
+    return unicode.normalize('NFC', title.replace('_', ' ')).casefold().strip()
+
+# it's kept up to date by the indexer like the other indexes, but lives in memory, so its "head" does too
+class TitleIndex:
+    moves_need_document = False
+    needs_documents = False
+    shared = False
+
+    def __init__(self, site, max_candidates=100):
+        self.site = site
+        self.max_candidates = max_candidates
+        self.version = None
+        # (keys, titles): keys are (key, filename) pairs for the whole title and for every later word in it, so
+        # "smith" finds "John Smith". Both are replaced together rather than changed, so readers can go on using
+        # whichever pair they picked up without any locking
+        self.entries = ([], {})
+
+    @property
+    def current_version(self):
+        if self.version is None: raise FileNotFoundError('the title index has not been built yet')
+        return self.version
+
+    @property
+    def indexed_revision(self):
+        return self.version
+
+    @property
+    def outdated(self):
+        return self.outdated_for(self.site.latest.revision)
+
+    def outdated_for(self, revision):
+        return self.version != revision
+
+    def set_version(self, revision):
+        self.version = revision
+
+    def update(self):
+        if self.site.indexer.background and self.version is not None: return
+        if not self.outdated: return
+        self.site.indexer.update()
+
+    def entries_for(self, filename):
+        words = title_key(filename_to_title(filename)).split()
+        return [(' '.join(words[i:]), filename) for i in range(len(words))]
+
+    def do_create(self):
+        # a rebuild is put together in do_commit, and readers keep the old entries until then
+        pass
+
+    def do_begin(self, rebuilding=False, revision=None):
+        self.rebuilding = rebuilding
+        self.pending = []
+
+    def do_apply(self, change, document):
+        self.pending.append(change)
+
+    def do_commit(self):
+        keys, titles = self.entries
+        titles = {} if self.rebuilding else dict(titles)
+        removed = set()
+        for change in self.pending:
+            if change.op in {'deleted', 'moved'}:
+                filename = change.old_page or change.page
+                if titles.pop(filename, None) is not None: removed.add(filename)
+            if change.op in {'created', 'moved'}:
+                titles[change.page] = filename_to_title(change.page)
+                removed.discard(change.page)
+
+        if self.rebuilding:
+            keys = [entry for filename in titles for entry in self.entries_for(filename)]
+        else:
+            added = {change.page for change in self.pending if change.op in {'created', 'moved'}}
+            keys = [entry for entry in keys if entry[1] not in removed and entry[1] not in added]
+            keys.extend(entry for filename in added if filename in titles for entry in self.entries_for(filename))
+        # one sort, rather than an insertion per entry; when only a few entries were added the list is nearly
+        # sorted already, which Python's sort makes quick work of
+        keys.sort()
+
+        self.entries = (keys, titles)
+        self.pending = []
+
+    def do_abort(self):
+        self.pending = []
+
+    # nothing starts the way it was typed, so allow for a typo: difflib only looks at a bounded number of titles
+    # sharing the longest prefix there is with what was typed, never at a whole range of the index
+    def close_matches(self, keys, key, limit):
+        candidates = {}
+        for length in range(len(key) - 1, 0, -1):
+            start = bisect_left(keys, (key[:length],))
+            for entry_key, filename in keys[start:start + self.max_candidates]:
+                if not entry_key.startswith(key[:length]) or len(candidates) >= self.max_candidates: break
+                candidates.setdefault(entry_key[:len(key) + 2], filename)
+            if len(candidates) >= self.max_candidates: break
+
+        found = []
+        for close in difflib.get_close_matches(key, list(candidates), n=limit, cutoff=0.75):
+            if candidates[close] not in found: found.append(candidates[close])
+        return found
+
+    def complete(self, prefix, limit=10):
+        self.update()
+        key = title_key(prefix)
+        if not key: return []
+
+        keys, titles = self.entries
+        found = []
+        index = bisect_left(keys, (key,))
+        # whole-title matches sort first, then pages where a later word matches
+        while index < len(keys) and keys[index][0].startswith(key) and len(found) < limit * 4:
+            filename = keys[index][1]
+            if filename not in found: found.append(filename)
+            index += 1
+        found.sort(key=lambda filename: (not title_key(titles[filename]).startswith(key), len(filename)))
+        found = found[:limit]
+
+        if not found:
+            found = self.close_matches(keys, key, limit)
+
+        return [{'title': titles[filename], 'url': filename_to_url(filename)} for filename in found]
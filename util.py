@@ -1,7 +1,8 @@
+import os.path
 import urllib.parse as urlparse
 import unicodedata as unicode
 
-from jinja2 import BaseLoader, TemplateNotFound
+from jinja2 import BaseLoader, FileSystemBytecodeCache, TemplateNotFound
 import lxml.html.html5parser as html5
 import lxml.html
 import html5lib
@@ -41,17 +42,41 @@ def serialize_fragment(h):
     s = html5lib.serializer.HTMLSerializer()
     return ''.join(s.serialize(stream))[5:-6]
 
+# latest is a callable returning the revision the current request is being served from (the site's snapshot),
+# so checking a template is fresh never has to resolve HEAD itself
 class StorageTemplateLoader(BaseLoader):
-    def __init__(self, storage):
-        self.storage = storage
+    def __init__(self, latest):
+        self.latest = latest
+    
+    def template_id(self, revision, template):
+        templates = revision.dir('templates')
+        if template not in templates: return None
+        return templates.get_id(template)
     
     def get_source(self, environment, template):
-        latest = self.storage.latest()
-        templates = latest.dir('templates')
-        
-        try:
-            source = templates.get(template).decode('utf-8')
-        except FileNotFoundError:
+        revision = self.latest()
+        templates = revision.dir('templates')
+        if template not in templates:
             raise TemplateNotFound(template)
         
-        return source, None, lambda: latest.revision == self.storage.latest().revision
+        source = templates.get(template).decode('utf-8')
+        blob_id = templates.get_id(template)
+        
+        # the snapshot is only replaced when HEAD moves, and commits which don't touch this template leave its
+        # blob id, and so the compiled template, alone
+        checked = [revision]
+        def uptodate():
+            current = self.latest()
+            if current is checked[0]: return True
+            if self.template_id(current, template) != blob_id: return False
+            checked[0] = current
+            return True
+        
+        return source, 'templates/' + template, uptodate
+
+# keys each template by its name and its source checksum, which is as good as keying by blob id, and
+# being on disk lets every worker process share one compiled copy
+def storage_bytecode_cache(storage):
+    cache_dir = os.path.join(storage.repo.path, 'templates.cache')
+    if not os.path.isdir(cache_dir): os.mkdir(cache_dir)
+    return FileSystemBytecodeCache(cache_dir)
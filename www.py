@@ -7,6 +7,11 @@ from werkzeug.wrappers import Request as BaseRequest, Response
 from werkzeug.serving import run_simple
 from werkzeug.datastructures import ImmutableOrderedMultiDict
 
+if "." in __name__:
+    from .asgi import ASGIApplication
+else:
+    from asgi import ASGIApplication
+
 
 class Request(BaseRequest):
     parameter_storage_class = ImmutableOrderedMultiDict
@@ -34,6 +39,9 @@ def JSONResponse(obj, code=200, headers={}):
         headers.update({'Content-Type': 'application/json'})
     )
 
+def RedirectResponse(location, code=302):
+    return Response('', code, {'Location': location})
+
 class MethodNotAllowed(Exception): pass
 class Application:
     def wsgi_app(self, environ, start_response):
@@ -49,6 +57,7 @@ class Application:
         except MethodNotAllowed:
             response = Response('Method %s is not allowed on this resource.' % (request.method), 405)
         
+        response = self.after_request(request, response)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
@@ -57,6 +66,13 @@ class Application:
     def run(self):
         run_simple('127.0.0.1', 3000, self, use_debugger=True)
     
+    # for ASGI servers, e.g. `uvicorn --factory` with a function returning Ikwi(path).asgi()
+    def asgi(self, **kwargs):
+        return ASGIApplication(self, **kwargs)
+    
+    def after_request(self, request, response):
+        return response
+    
     def require_method(self, request, methods):
         if request.method not in methods:
             raise MethodNotAllowed